@@ -0,0 +1,170 @@
+import os
+
+import numpy as np
+import pytest
+
+import env.envs as E
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "default_env_config.yaml")
+
+# (task_type, periodic_boundary, comm_range, num_agents_pool, custom_topology)
+CASES = [
+    ("acs", False, None, [20], None),
+    ("acs", False, 60.0, [8, 12, 20], None),
+    ("acs", True, None, [8, 12, 20], None),
+    ("acs", True, 60.0, [20], None),
+    ("acs", False, None, [8, 12, 20], "line"),
+    ("acs", False, None, [20], "star"),
+    ("vicsek", False, None, [8, 12, 20], None),
+    ("vicsek", False, 60.0, [20], None),
+    ("vicsek", True, 60.0, [8, 12, 20], None),
+    ("vicsek", True, None, [20], "line"),
+]
+
+# Kernels the compiled step path runs through; replaced by their pure-Python versions with numba forced off
+_KERNELS = ("_step_core", "_acs_control_kernel", "_vicsek_control_kernel", "_headings_to_velocities")
+
+
+def make_env(task_type, periodic_boundary, comm_range, num_agents_pool, custom_topology, seed=0):
+    config = E.load_config(CONFIG_PATH)
+    config.env.task_type = task_type
+    config.env.periodic_boundary = periodic_boundary
+    config.env.obs_dim = 6 if periodic_boundary else 4
+    config.env.comm_range = comm_range
+    config.env.num_agents_pool = num_agents_pool
+    config.env.enable_custom_topology = custom_topology is not None
+    config.env.custom_topology = custom_topology
+    config.env.get_state_hist = True
+    config.env.max_time_steps = 100
+    env = E.LazyControlFlockingEnv({"seed_id": seed, "config": config})
+    env.reset()
+    return env
+
+
+@pytest.mark.parametrize("use_numba", [True, False], ids=["numba", "no_numba"])
+@pytest.mark.parametrize("case", CASES, ids=lambda case: "-".join(str(x) for x in case))
+def test_step_core_matches_python_step(case, use_numba, monkeypatch):
+    """
+    _step_core (control inputs, lazy action and state integration in one call) must agree with the Python path
+    of env_transition (get_*_control and update_agent_states) on the same state and action
+    """
+    if not E.NUMBA_AVAILABLE:
+        pytest.skip("numba is not installed; the step core is not used")
+    env = make_env(*case)
+    step_constants = env._get_step_constants()
+    assert step_constants is not None
+    if not use_numba:
+        monkeypatch.setattr(E, "NUMBA_AVAILABLE", False)
+        for name in _KERNELS:
+            monkeypatch.setattr(E, name, getattr(E, name).py_func)
+
+    rng = np.random.default_rng(1)
+    for _ in range(20):
+        state, rel_state = env.state, env.rel_state
+        action = env.validate_action(action=env.interpret_action(rng.uniform(0, 1, env.num_agents_max)),
+                                     neighbor_masks=state["neighbor_masks"], padding_mask=state["padding_mask"])
+
+        env._step_constants = step_constants
+        next_state, control_inputs, _ = env.env_transition(state, rel_state, action)
+        core_agent_states, core_control_inputs = next_state["agent_states"].copy(), control_inputs.copy()
+
+        env._step_constants = None
+        next_state, control_inputs, _ = env.env_transition(state, rel_state, action)
+
+        padding_mask = state["padding_mask"]
+        np.testing.assert_allclose(core_control_inputs[padding_mask], control_inputs[padding_mask],
+                                   rtol=1e-4, atol=1e-5)
+        np.testing.assert_allclose(core_agent_states[padding_mask], next_state["agent_states"][padding_mask],
+                                   rtol=1e-4, atol=1e-4)
+
+        env.step(action)
+
+
+@pytest.mark.parametrize("case", CASES, ids=lambda case: "-".join(str(x) for x in case))
+def test_numba_and_numpy_episodes_match(case, monkeypatch):
+    """
+    A short episode through step() with numba (the compiled step core and kernels) and with numba forced off
+    (the numpy control laws); small per-step differences from fastmath are allowed to accumulate a little
+    """
+    if not E.NUMBA_AVAILABLE:
+        pytest.skip("numba is not installed")
+
+    def run_episode():
+        env = make_env(*case)
+        rng = np.random.default_rng(1)
+        for _ in range(20):
+            env.step(rng.uniform(0, 1, env.num_agents_max).astype(np.float32))
+        return env.agent_states_hist[:env.time_step], env.neighbor_masks_hist[:env.time_step]
+
+    numba_states, numba_masks = run_episode()
+    monkeypatch.setattr(E, "NUMBA_AVAILABLE", False)
+    numpy_states, numpy_masks = run_episode()
+
+    np.testing.assert_allclose(numba_states, numpy_states, rtol=1e-4, atol=1e-3)
+    np.testing.assert_array_equal(numba_masks, numpy_masks)
+
+
+@pytest.mark.parametrize("get_state_hist", [False, True], ids=["no_hist", "hist"])
+@pytest.mark.parametrize("custom_topology", [None, "line"], ids=["full", "line"])
+def test_fixed_topology_obs_masks_are_independent(custom_topology, get_state_hist):
+    """
+    With a fixed topology (comm_range is None) every step hands out its own neighbor masks: editing one step's
+    obs in place must not leak into the masks of the next steps
+    """
+    env = make_env("acs", False, None, [8, 12, 20], custom_topology)
+    env.config.env.get_state_hist = get_state_hist
+    obs = env.reset()
+    initial_masks = obs["neighbor_masks"].copy()
+    action = np.zeros(env.num_agents_max, dtype=np.float32)
+    for _ in range(3):
+        obs["neighbor_masks"][:] = False  # e.g. a wrapper masking the obs in place
+        obs, _, _, _ = env.step(action)
+        np.testing.assert_array_equal(obs["neighbor_masks"], initial_masks)
+        np.testing.assert_array_equal(env.state["neighbor_masks"], initial_masks)
+
+
+# (config overrides, whether communication must drop during the episode)
+BATCHED_CASES = [
+    ({}, False),
+    ({"task_type": "vicsek", "num_agents_pool": [8, 12, 20]}, False),
+    ({"periodic_boundary": True, "obs_dim": 6, "comm_range": 60.0}, True),
+    ({"num_agents_pool": [8, 12, 20], "comm_range": 25.0, "ignore_comm_lost_agents": True}, True),
+]
+
+
+@pytest.mark.parametrize("overrides, drops_comm", BATCHED_CASES, ids=["acs", "vicsek", "periodic", "comm_loss"])
+def test_batched_env_matches_single_env(overrides, drops_comm):
+    """
+    Each world of BatchedLazyControlFlockingEnv must step like a LazyControlFlockingEnv started from the same states,
+    including the communication-loss bookkeeping (has_lost_comm, lost_comm_step)
+    """
+    config = E.load_config(CONFIG_PATH).dict()
+    config["env"].update(overrides)
+    batch_size = 3
+    batched_env = E.BatchedLazyControlFlockingEnv({"seed_id": 0, "config": config, "batch_size": batch_size})
+    batched_env.reset()
+
+    envs = []
+    for b in range(batch_size):
+        env = E.LazyControlFlockingEnv({"seed_id": 0, "config": config})
+        agent_states = batched_env.state["agent_states"][b, :batched_env.num_agents[b]]
+        env.custom_reset(agent_states[:, :2].copy(), agent_states[:, 2:4].copy(), agent_states[:, 4:5].copy(),
+                         num_agents_max=env.num_agents_max, comm_range=config["env"]["comm_range"])
+        envs.append(env)
+
+    rng = np.random.default_rng(0)
+    for _ in range(60):
+        action = rng.uniform(0, 0.5, (batch_size, batched_env.num_agents_max)).astype(np.float32)
+        batched_obs, batched_reward, batched_done, _ = batched_env.step(action)
+        for b, env in enumerate(envs):
+            obs, reward, done, _ = env.step(action[b])
+            np.testing.assert_allclose(env.state["agent_states"], batched_env.state["agent_states"][b], atol=1e-3)
+            np.testing.assert_allclose(reward, batched_reward[b], rtol=1e-4, atol=1e-4)
+            assert done == batched_done[b]
+            if config["env"]["comm_range"] is not None:
+                np.testing.assert_array_equal(obs["neighbor_masks"], batched_obs["neighbor_masks"][b])
+            assert env.has_lost_comm == batched_env.has_lost_comm[b]
+            if env.has_lost_comm:
+                assert env.lost_comm_step == batched_env.lost_comm_step[b]
+
+    assert batched_env.has_lost_comm.any() == drops_comm
@@ -1,25 +1,38 @@
 import os
-from copy import deepcopy
+import math
+import functools
 import warnings
+from collections import deque, namedtuple
 import gym  # gym 0.23.1
 from gym.utils import seeding
 from gym.spaces import Box, Discrete, Dict, MultiDiscrete, MultiBinary
+from gym.vector.utils import batch_space
 import numpy as np  # numpy 1.23.4
+from scipy.spatial import cKDTree
 from ray.rllib.utils.typing import (
     AgentID,
     MultiAgentDict,
 )
 from ray.tune.logger import pretty_print
-from utils.utils import (wrap_to_pi, wrap_to_rectangle,
-                              get_rel_pos_dist_in_periodic_boundary, map_periodic_to_continuous_space)
+from utils.utils import wrap_to_pi, wrap_to_rectangle, map_periodic_to_continuous_space
 from typing import List, Optional
 # from pydantic import BaseModel, field_validator, model_validator, ConfigDict, conlist, conint, confloat  # v2
 from pydantic import BaseModel, Field, conlist, conint, validator, root_validator  # v1
 import yaml
 import matplotlib.pyplot as plt
 from matplotlib.patches import Arrow
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
 import matplotlib.gridspec as gridspec
-import copy
+try:
+    from numba import njit, prange  # optional; jit-compiles the per-step control kernels
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+    prange = range
+
+    def njit(*args, **kwargs):  # no-op stand-in so the kernels below still define; they are not called
+        return args[0] if len(args) == 1 and callable(args[0]) else (lambda f: f)
 
 
 class ControlConfig(BaseModel):
@@ -103,18 +116,20 @@ class Config(BaseModel):
 
 
 def load_dict(path: str) -> dict:
+    # Use the libyaml C loader when available; falls back to the pure-Python SafeLoader otherwise
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
     with open(path, 'r') as f:
-        config_dict = yaml.safe_load(f)
+        config_dict = yaml.load(f, Loader=loader)
     # return Config(**config_dict)
     return config_dict
 
 
-def load_config(something=None):
+def load_config(something=None, validated=False):
     if something is None:
         print("Warning: No config is provided; using the default config.")
         return Config(**load_dict('./env/default_env_config.yaml'))
     elif isinstance(something, dict):
-        return Config(**something)
+        return construct_config(something) if validated else Config(**something)
     elif isinstance(something, str):
         if os.path.exists(something):
             return Config(**load_dict(something))
@@ -126,8 +141,318 @@ def load_config(something=None):
         raise TypeError(f"Invalid type: {type(something)}")
 
 
+def construct_config(config_dict: dict) -> Config:
+    """
+    Builds a Config from a dict that has already been validated (e.g. the output of Config.dict()) without
+    re-running the pydantic validators; use load_config(config_dict) for anything user-provided
+    """
+    return Config.construct(control=ControlConfig.construct(**config_dict["control"]),
+                            env=EnvConfig.construct(**config_dict["env"]))
+
+
 def config_to_env_input(config_instance: Config, seed_id: Optional[int] = None) -> dict:
-    return {"seed_id": seed_id, "config": config_instance.dict()}
+    # config_validated: the dict comes from a validated Config, so the env can skip the validation on every worker
+    return {"seed_id": seed_id, "config": config_instance.dict(), "config_validated": True}
+
+
+def _build_spaces(env_mode: str, action_type: str, num_agents_max: int, obs_dim: int, agent_name_prefix: str):
+    """
+    Builds the (action_space, observation_space) of the env; fresh objects for every env, as gym spaces carry
+    their own np_random state (seeded per env)
+    """
+    # Define ACTION SPACE
+    if env_mode == "single_env":
+        if action_type == "laziness_vector":
+            action_space = Box(low=0, high=1, shape=(num_agents_max,), dtype=np.float32)
+        else:
+            raise NotImplementedError("action_type must be laziness_vector at this moment.")
+    elif env_mode == "multi_env":
+        if action_type == "binary_vector":
+            action_space = Dict({
+                agent_name_prefix + str(i): Box(low=0, high=1, shape=(num_agents_max,), dtype=np.bool_)
+                for i in range(num_agents_max)
+            })
+        else:
+            raise NotImplementedError("action_type must be binary_vector. "
+                                      "The radius and continuous_vector are still in alpha, sorry.")
+    else:
+        raise NotImplementedError("env_mode must be either single_env or multi_env")
+
+    # Define OBSERVATION SPACE
+    if env_mode == "single_env":
+        observation_space = Dict({
+            "local_agent_infos": Box(low=-np.inf, high=np.inf,
+                                     shape=(num_agents_max, num_agents_max, obs_dim), dtype=np.float32),
+            "neighbor_masks": Box(low=0, high=1, shape=(num_agents_max, num_agents_max), dtype=np.bool_),
+            "padding_mask": Box(low=0, high=1, shape=(num_agents_max,), dtype=np.bool_),
+            "is_from_my_env": Box(low=0, high=2, shape=(), dtype=np.float16),
+        })
+    else:  # multi_env
+        observation_space = Dict({
+            agent_name_prefix + str(i): Dict({
+                "centralized_agent_info": Box(low=-np.inf, high=np.inf, shape=(5,), dtype=np.float32),
+                "neighbor_mask": Box(low=0, high=1, shape=(num_agents_max,), dtype=np.bool_),
+                "padding_mask": Box(low=0, high=1, shape=(num_agents_max,), dtype=np.bool_)
+            }) for i in range(num_agents_max)
+        })
+
+    return action_space, observation_space
+
+
+# Above this fraction of neighbor pairs, the numpy control path uses the dense N^2 terms instead of the edge list
+_SPARSE_NET_MAX_DENSITY = 0.3
+
+# psi(r) = (1 + r^2)^(-beta) evaluation modes; libm pow is avoided for the common betas
+_PSI_GENERAL = 0  # exp(-beta * log1p(r^2))
+_PSI_INTEGER = 1  # (1 / (1 + r^2))^beta by repeated multiplication
+_PSI_SQRT = 2     # beta == 1/2
+_PSI_CBRT = 3     # beta == 1/3 (the default)
+
+
+def _get_psi_mode(beta):
+    """
+    Picks the cheapest exact form of psi(r) = (1 + r^2)^(-beta) for the given beta
+    :param beta: communication decay rate
+    :return: one of _PSI_GENERAL, _PSI_INTEGER, _PSI_SQRT, _PSI_CBRT
+    """
+    if beta == 0.5:
+        return _PSI_SQRT
+    if abs(beta - 1. / 3.) < 1e-12:
+        return _PSI_CBRT
+    if beta >= 1 and float(beta).is_integer():
+        return _PSI_INTEGER
+    return _PSI_GENERAL
+
+
+def _compute_psi(r2, beta, psi_mode):
+    """
+    psi(r) = (1 + r^2)^(-beta) over an array of squared distances (numpy path)
+    :param r2: ndarray of squared distances
+    :param beta: communication decay rate
+    :param psi_mode: from _get_psi_mode(beta)
+    :return: psi; same shape as r2
+    """
+    if psi_mode == _PSI_SQRT:
+        return 1.0 / np.sqrt(1.0 + r2)
+    if psi_mode == _PSI_CBRT:
+        return 1.0 / np.cbrt(1.0 + r2)
+    if psi_mode == _PSI_INTEGER:
+        inv = 1.0 / (1.0 + r2)
+        psi = inv.copy()
+        for _ in range(int(beta) - 1):
+            psi *= inv
+        return psi
+    return np.exp(-beta * np.log1p(r2))
+
+
+@njit(cache=True, fastmath=True, parallel=True)
+def _acs_control_kernel(p, r, v, cos_th, sin_th, net, padding_mask, beta, psi_mode, lam, sig, k1, k2, r0, spd, u_max, u):
+    """
+    ACS control inputs; fuses the pairwise terms of get_acs_control into one loop over the padded arrays
+    :param p: (num_agents_max, num_agents_max, 2) relative positions
+    :param r: (num_agents_max, num_agents_max) relative distances
+    :param v: (num_agents_max, num_agents_max, 2) relative velocities
+    :param cos_th: (num_agents_max, ) cos of the absolute headings
+    :param sin_th: (num_agents_max, ) sin of the absolute headings
+    :param net: (num_agents_max, num_agents_max) neighbor masks
+    :param padding_mask: (num_agents_max, ) padded agents get a zero control input
+    :param psi_mode: from _get_psi_mode(beta)
+    :param u: (num_agents_max, ) output buffer; every entry is written
+    :return: u (num_agents_max, )
+    """
+    n = cos_th.shape[0]
+    eps = np.finfo(np.float64).eps
+    beta_int = int(beta)
+    half_k1 = 0.5 * k1
+    half_k2 = 0.5 * k2
+    for i in prange(n):
+        if not padding_mask[i]:
+            u[i] = 0.0
+            continue
+        sin_th_i = -sin_th[i]
+        cos_th_i = cos_th[i]
+        num_neighbors = eps
+        acc_cs = 0.0
+        acc_coh = 0.0
+        for j in range(n):
+            if not (net[i, j] and padding_mask[j]):
+                continue
+            num_neighbors += 1.0
+            if j == i:  # self-loop: zero relative position, so it only counts toward the neighbor number
+                continue
+            r_ij = r[i, j]
+            r2 = r_ij * r_ij
+            inv_r = 1.0 / r_ij  # one division per pair; reused by both cohesion terms
+            # Alignment: psi(r_ij) * sin(θ_j - θ_i); psi_mode is loop-invariant, so the branch predicts perfectly
+            if psi_mode == _PSI_CBRT:
+                psi = 1.0 / np.cbrt(1.0 + r2)
+            elif psi_mode == _PSI_SQRT:
+                psi = 1.0 / np.sqrt(1.0 + r2)
+            elif psi_mode == _PSI_INTEGER:
+                inv = 1.0 / (1.0 + r2)
+                psi = inv
+                for _ in range(beta_int - 1):
+                    psi *= inv
+            else:
+                psi = np.exp(-beta * np.log1p(r2))
+            acc_cs += psi * (sin_th[j] * cos_th_i + cos_th[j] * sin_th_i)  # sin(θ_j - θ_i), no per-pair trig
+            # Cohesion and separation
+            v_dot_p = v[i, j, 0] * p[i, j, 0] + v[i, j, 1] * p[i, j, 1]
+            dir_dot_p = sin_th_i * p[i, j, 0] + cos_th_i * p[i, j, 1]
+            acc_coh += (half_k1 * inv_r * inv_r * v_dot_p + half_k2 * inv_r * (r_ij - r0)) * dir_dot_p
+        u_i = (lam / num_neighbors) * acc_cs + (sig / (num_neighbors * spd)) * acc_coh
+        # Saturation
+        u[i] = min(max(u_i, -u_max), u_max)
+    return u
+
+
+@njit(cache=True, fastmath=True, parallel=True)
+def _vicsek_control_kernel(th, net, padding_mask, dt, u_max, u):
+    """
+    Vicsek control inputs over the padded arrays
+    :param th: (num_agents_max, num_agents_max) relative headings
+    :param net: (num_agents_max, num_agents_max) neighbor masks
+    :param padding_mask: (num_agents_max, ) padded agents get a zero control input
+    :param u: (num_agents_max, ) output buffer; every entry is written
+    :return: u (num_agents_max, )
+    """
+    n = th.shape[0]
+    eps = np.finfo(np.float64).eps
+    for i in prange(n):
+        if not padding_mask[i]:
+            u[i] = 0.0
+            continue
+        num_neighbors = eps
+        acc = 0.0
+        for j in range(n):
+            if net[i, j] and padding_mask[j]:
+                num_neighbors += 1.0
+                acc += th[i, j]
+        u_i = acc / num_neighbors / dt
+        u[i] = min(max(u_i, -u_max), u_max)
+    return u
+
+
+@njit(cache=True, fastmath=True)
+def _headings_to_velocities(h, v, out):
+    """
+    Velocities (v cos(h), v sin(h)) in one loop; numba lowers the adjacent cos/sin of h[i] to a single sincos call
+    :param h: (num_agents, ) headings
+    :param v: speed
+    :param out: (num_agents, 2) output buffer; every entry is written
+    :return: out (num_agents, 2)
+    """
+    for i in range(h.shape[0]):  # O(N); too little work to pay for the prange thread pool
+        h_i = h[i]
+        out[i, 0] = v * np.cos(h_i)
+        out[i, 1] = v * np.sin(h_i)
+    return out
+
+
+@njit(cache=True)
+def _entropy_kernel(agent_states):
+    """
+    Spatial and velocity entropies, sqrt(var(x) + var(y)) and sqrt(var(vx) + var(vy)), in one pass over the rows
+    (Welford's update in float64; population variances as np.var)
+    :param agent_states: (num_agents, >=4) states of the active agents
+    :return: spatial_entropy, velocity_entropy
+    """
+    mean = np.zeros(4)
+    m2 = np.zeros(4)
+    for i in range(agent_states.shape[0]):
+        inv_count = 1.0 / (i + 1)
+        for k in range(4):
+            x = np.float64(agent_states[i, k])
+            delta = x - mean[k]
+            mean[k] += delta * inv_count
+            m2[k] += delta * (x - mean[k])
+    n = agent_states.shape[0]
+    return np.sqrt((m2[0] + m2[1]) / n), np.sqrt((m2[2] + m2[3]) / n)
+
+
+# Per-step scalars for _step_core, unpacked from the config once per reset (numba takes a namedtuple of scalars)
+_StepConstants = namedtuple("_StepConstants", [
+    "is_acs", "beta", "psi_mode", "lam", "sig", "k1", "k2", "r0", "speed", "u_max", "dt", "periodic", "bound"])
+
+
+@njit(cache=True, fastmath=True)
+def _step_core(agent_states, rel_pos, rel_dist, rel_vel, rel_ang, cos_th, sin_th, net, padding_mask, action, c,
+               u_buf, u, out):
+    """
+    Steps 1.-3. of env_transition in one compiled call: control inputs, lazy action, state integration
+    :param agent_states: (num_agents_max, 5) current agent states
+    :param rel_ang: (num_agents_max, num_agents_max) relative headings (vicsek only)
+    :param cos_th: (num_agents_max, ) cos of the absolute headings (acs only)
+    :param sin_th: (num_agents_max, ) sin of the absolute headings (acs only)
+    :param action: (num_agents_max, ) laziness of the agents
+    :param c: _StepConstants
+    :param u_buf: (num_agents_max, ) scratch buffer for the flocking control inputs
+    :param u: (num_agents_max, ) output buffer for the lazy control inputs
+    :param out: (num_agents_max, 5) output buffer for the next agent states
+    :return: out, u
+    """
+    if c.is_acs:
+        _acs_control_kernel(rel_pos, rel_dist, rel_vel, cos_th, sin_th, net, padding_mask, c.beta, c.psi_mode,
+                            c.lam, c.sig, c.k1, c.k2, c.r0, c.speed, c.u_max, u_buf)
+    else:
+        _vicsek_control_kernel(rel_ang, net, padding_mask, c.dt, c.u_max, u_buf)
+    half_bound = c.bound / 2
+    for i in range(agent_states.shape[0]):
+        if not padding_mask[i]:  # the padded agents stay at zero
+            u[i] = 0.0
+            for k in range(5):
+                out[i, k] = 0.0
+            continue
+        u_i = (1 - action[i]) * u_buf[i]
+        u[i] = u_i
+        x = agent_states[i, 0] + agent_states[i, 2] * c.dt
+        y = agent_states[i, 1] + agent_states[i, 3] * c.dt
+        if c.periodic:  # wrap_to_rectangle about the origin; % takes the sign of the divisor as in numpy
+            x = (x + half_bound) % c.bound - half_bound
+            y = (y + half_bound) % c.bound - half_bound
+        h = agent_states[i, 4] + u_i * c.dt
+        out[i, 0] = x
+        out[i, 1] = y
+        out[i, 2] = c.speed * np.cos(h)
+        out[i, 3] = c.speed * np.sin(h)
+        out[i, 4] = h
+    return out, u
+
+
+def _identity(x):
+    return x
+
+
+class _SlidingWindowExtrema:
+    """
+    Min and max over the values pushed in the last *window_length* time steps;
+    monotonic deques of (time_step, value), so each push is amortised O(1) instead of an O(window) rescan
+    """
+    def __init__(self, window_length):
+        self.window_length = window_length
+        self._min_dq = deque()  # values increasing from the left
+        self._max_dq = deque()  # values decreasing from the left
+
+    def push(self, time_step, value):
+        min_dq, max_dq = self._min_dq, self._max_dq
+        while min_dq and min_dq[-1][1] >= value:
+            min_dq.pop()
+        min_dq.append((time_step, value))
+        while max_dq and max_dq[-1][1] <= value:
+            max_dq.pop()
+        max_dq.append((time_step, value))
+        # Evict the entries that fell out of [time_step - window_length + 1, time_step]
+        oldest = time_step - self.window_length + 1
+        while min_dq[0][0] < oldest:
+            min_dq.popleft()
+        while max_dq[0][0] < oldest:
+            max_dq.popleft()
+
+    def min(self):
+        return self._min_dq[0][1]
+
+    def max(self):
+        return self._max_dq[0][1]
 
 
 class LazyControlFlockingEnv(gym.Env):
@@ -136,7 +461,7 @@ class LazyControlFlockingEnv(gym.Env):
         seed_id = env_context['seed_id'] if 'seed_id' in env_context else None
         self.seed(seed_id)
 
-        self.config = load_config(env_context['config'])
+        self.config = load_config(env_context['config'], validated=env_context.get('config_validated', False))
 
         self.num_agents: Optional[int] = None  # defined in reset()
         self.num_agents_min: Optional[int] = None  # defined in _validate_config()
@@ -149,6 +474,8 @@ class LazyControlFlockingEnv(gym.Env):
         #                                        1 if neighbor, 0 if not;  self-loop is 1 (check your self-loops).
         #                     "padding_mask":   ndarray,  # shape (num_agents_max)
         #                                        1 if agent,    0 if padding
+        #                     "padding_mask_2d": ndarray, # shape (num_agents_max, num_agents_max)
+        #                                        outer product of padding_mask; built once per reset
         # # # rel_state: dict := {"rel_agent_positions": ndarray,   # shape (num_agents_max, num_agents_max, 2)
         #                         "rel_agent_velocities": ndarray,  # shape (num_agents_max, num_agents_max, 2)
         #                         "rel_agent_headings": ndarray,    # shape (num_agents_max, num_agents_max)  # 2-D !!!
@@ -168,49 +495,71 @@ class LazyControlFlockingEnv(gym.Env):
         # ACS hist
         self.spatial_entropy_hist = None
         self.velocity_entropy_hist = None
+        # Sliding min/max of the histories over the termination windows; see check_episode_termination()
+        self._alignment_window = None
+        self._spatial_entropy_window = None
+        self._velocity_entropy_window = None
 
         self._validate_config()
-
-        # Define ACTION SPACE
-        self.action_dtype = None
-        if self.config.env.env_mode == "single_env":
-            if self.config.env.action_type == "laziness_vector":
-                self.action_dtype = np.float32
-                self.action_space = Box(low=0, high=1, shape=(self.num_agents_max,), dtype=self.action_dtype)
-            else:
-                raise NotImplementedError("action_type must be laziness_vector at this moment.")
-        elif self.config.env.env_mode == "multi_env":
-            print("WARNING (env.__init__): multi_env is experimental; not fully implemented yet")
-            if self.config.env.action_type == "binary_vector":
-                self.action_space = Dict({
-                    self.config.env.agent_name_prefix + str(i): Box(low=0, high=1,
-                                                                    shape=(self.num_agents_max,), dtype=np.bool_)
-                    for i in range(self.num_agents_max)
-                })
-            else:
-                raise NotImplementedError("action_type must be binary_vector. "
-                                          "The radius and continuous_vector are still in alpha, sorry.")
+        # Agent names used as the keys of the multi-agent dicts; built once instead of on every conversion
+        self._agent_keys = [f"{self.config.env.agent_name_prefix}{i}" for i in range(self.num_agents_max)]
+        # Active-agent indices of the current padding_mask; see get_active_agents_indices()
+        self._indexed_padding_mask = None
+        # Control-input buffer reused every step; only read within env_transition (the lazy product is a new array)
+        self._control_inputs_buf = np.empty(self.num_agents_max, dtype=np.float32)
+        # Next-agent-state buffers used when there is no history row to integrate into; step() alternates between
+        # the two, so the state of the previous step stays intact while the next one is written
+        self._agent_states_bufs = (np.zeros((self.num_agents_max, 5), dtype=np.float32),
+                                   np.zeros((self.num_agents_max, 5), dtype=np.float32))
+        # Per-agent dones of the multi-env; refilled in check_episode_termination()
+        self._dones_buf = np.ones(self.num_agents_max, dtype=np.bool_)
+        # Fixed-topology neighbor masks (comm_range is None), read-only; set in reset() and copied in every step
+        self._fixed_neighbor_masks = None
+        self._active_agents_indices = None
+        self._active_agents_indices_2d = None
+        # Config scalars of the compiled step path; see _get_step_constants()
+        self._step_constants = None
+
+        # Resolve the per-step mode branches once; the config does not change over the life of the env
+        task_type = self.config.env.task_type
+        if task_type == "acs":
+            self._get_control = self.get_acs_control
+            self._psi_mode = _get_psi_mode(self.config.control.beta)
+        elif task_type == "vicsek":
+            self._get_control = self.get_vicsek_control
         else:
-            raise NotImplementedError("env_mode must be either single_env or multi_env")
-
-        # Define OBSERVATION SPACE
-        if self.config.env.env_mode == "single_env":
-            self.observation_space = Dict({
-                "local_agent_infos": Box(low=-np.inf, high=np.inf,
-                                         shape=(self.num_agents_max, self.num_agents_max, self.config.env.obs_dim),
-                                         dtype=np.float64),
-                "neighbor_masks": Box(low=0, high=1, shape=(self.num_agents_max, self.num_agents_max), dtype=np.bool_),
-                "padding_mask": Box(low=0, high=1, shape=(self.num_agents_max,), dtype=np.bool_),
-                "is_from_my_env": Box(low=0, high=2, shape=(), dtype=np.float16),
-            })
-        elif self.config.env.env_mode == "multi_env":
-            self.observation_space = Dict({
-                self.config.env.agent_name_prefix + str(i): Dict({
-                    "centralized_agent_info": Box(low=-np.inf, high=np.inf, shape=(5,), dtype=np.float64),
-                    "neighbor_mask": Box(low=0, high=1, shape=(self.num_agents_max,), dtype=np.bool_),
-                    "padding_mask": Box(low=0, high=1, shape=(self.num_agents_max,), dtype=np.bool_)
-                }) for i in range(self.num_agents_max)
-            })
+            raise NotImplementedError("task_type must be either vicsek or acs")
+        if self.config.env.env_mode == "multi_env":
+            self._to_joint_action = self.multi_to_single
+            self._reduce_rewards = self.single_to_multi
+        else:  # single_env
+            self._to_joint_action = _identity
+            self._reduce_rewards = self._mean_reward
+        # Custom reward used by step(): a subclass override of compute_custom_reward, else the built-in branch
+        if type(self).compute_custom_reward is not LazyControlFlockingEnv.compute_custom_reward:
+            self._custom_reward = self.compute_custom_reward
+        elif self.config.env.is_training and task_type == "acs":
+            self._custom_reward = self._compute_acs_reward
+        else:
+            self._custom_reward = self._compute_no_reward
+        # Scalars of the custom (training) reward in _compute_acs_reward, folded once: the error weights carry the
+        # 1/3600 and 1/220 normalizers, and the cruise cost is rho * dt
+        env_cfg = self.config.env
+        if env_cfg.is_training and task_type == "acs":
+            self._std_pos_target = env_cfg.entropy_p_goal - 2.5
+            self._std_vel_target = env_cfg.entropy_v_goal - 0.05
+            self._w_pos = env_cfg.acs_train_w_pos / 3600  # (100-40)**2 = 3600
+            self._w_vel = env_cfg.acs_train_w_vel / 220   # (15-0.05)**2 = 223.5052
+            self._w_ctrl = env_cfg.acs_train_w_ctrl
+            self._rho_dt = self.config.control.rho * env_cfg.dt
+
+        # Define ACTION SPACE and OBSERVATION SPACE; fresh space objects per env (each carries its own np_random)
+        if self.config.env.env_mode == "multi_env":
+            print("WARNING (env.__init__): multi_env is experimental; not fully implemented yet")
+        self.action_space, self.observation_space = _build_spaces(
+            self.config.env.env_mode, self.config.env.action_type, int(self.num_agents_max),
+            self.config.env.obs_dim, self.config.env.agent_name_prefix)
+        self.action_dtype = self.action_space.dtype.type if self.config.env.env_mode == "single_env" else None
 
     def seed(self, seed=None):
         self.np_random, seed = seeding.np_random(seed)
@@ -224,7 +573,7 @@ class LazyControlFlockingEnv(gym.Env):
             print(pretty_print(default_config.dict()))
             # print(default_config.model_dump())
             print('----------------------------------------------------')
-            return deepcopy(default_config.dict())
+            return default_config.dict()  # .dict() already builds a fresh nested dict
         except FileNotFoundError:
             warnings.warn("Warning: 'default_env_config.yaml' not found. Check the file path.")
             return None
@@ -322,24 +671,23 @@ class LazyControlFlockingEnv(gym.Env):
         assert th_.shape[1] == 1, "th_ must have shape[1] == 1"
 
         # Get initial agent states
-        # # agent_states: [x, y, vx, vy, theta]
-        p = np.zeros((num_agents_max, 2), dtype=np.float64)  # (num_agents_max, 2)
-        p[:num_agents, :] = p_
-        v = np.zeros((num_agents_max, 2), dtype=np.float64)  # (num_agents_max, 2)
-        v[:num_agents, :] = v_
-        th = np.zeros(num_agents_max, dtype=np.float64)  # (num_agents_max, )
-        th[:num_agents] = th_
-        # Concatenate p v th
-        agent_states = np.concatenate([p, v, th[:, np.newaxis]], axis=1)  # (num_agents_max, 5)
+        # # agent_states: [x, y, vx, vy, theta]; written in place (no intermediate p, v, th or concatenation)
+        agent_states = np.zeros((num_agents_max, 5), dtype=np.float32)  # (num_agents_max, 5)
+        agent_states[:num_agents, :2] = p_
+        agent_states[:num_agents, 2:4] = v_
+        agent_states[:num_agents, 4:5] = th_  # th_: (num_agents, 1)
         # # padding_mask
         padding_mask = np.zeros(num_agents_max, dtype=np.bool_)  # (num_agents_max, )
         padding_mask[:num_agents] = True
+        padding_mask_2d = padding_mask[:, np.newaxis] & padding_mask[np.newaxis, :]  # (num_agents_max, num_agents_max)
         # # neighbor_masks
         self.config.env.comm_range = comm_range
         neighbor_masks, _ = self.update_network_topology(agent_states, padding_mask, init=True)
+        self._set_fixed_neighbor_masks(neighbor_masks)
         # # state!
-        self.state = {"agent_states": agent_states, "neighbor_masks": neighbor_masks, "padding_mask": padding_mask}
-        self.initial_state = self.state
+        self.state = {"agent_states": agent_states, "neighbor_masks": neighbor_masks, "padding_mask": padding_mask,
+                      "padding_mask_2d": padding_mask_2d}
+        self.initial_state = {key: value.copy() for key, value in self.state.items()}  # snapshot, not an alias
         self.has_lost_comm = False
 
         # Get relative state
@@ -347,6 +695,7 @@ class LazyControlFlockingEnv(gym.Env):
 
         # Get obs
         obs = self.get_obs(state=self.state, rel_state=self.rel_state, control_inputs=np.zeros(num_agents_max))
+        self._step_constants = self._get_step_constants()
 
         return obs
 
@@ -359,22 +708,24 @@ class LazyControlFlockingEnv(gym.Env):
         self.num_agents = self.np_random.choice(self.num_agents_pool_np)  # randomly choose the num_agents
         padding_mask = np.zeros(self.num_agents_max, dtype=np.bool_)  # (num_agents_max, )
         padding_mask[:self.num_agents] = True
+        padding_mask_2d = padding_mask[:, np.newaxis] & padding_mask[np.newaxis, :]  # (num_agents_max, num_agents_max)
 
         # Init the state: agent_states [x,y,vx,vy,theta], neighbor_masks[T/F (n,n)], padding_mask[T/F (n)]
-        # # Generate initial agent states
-        p = np.zeros((self.num_agents_max, 2), dtype=np.float64)  # (num_agents_max, 2)
+        # # Generate initial agent states: [x, y, vx, vy, theta], written in place into a single buffer
+        n = self.num_agents
+        agent_states = np.zeros((self.num_agents_max, 5), dtype=np.float32)  # (num_agents_max, 5)
         l2 = self.config.control.initial_position_bound / 2
-        p[:self.num_agents, :] = self.np_random.uniform(-l2, l2, size=(self.num_agents, 2))
-        th = np.zeros(self.num_agents_max, dtype=np.float64)  # (num_agents_max, )
-        th[:self.num_agents] = self.np_random.uniform(-np.pi, np.pi, size=(self.num_agents,))
-        v = self.config.control.speed * np.stack([np.cos(th), np.sin(th)], axis=1)
-        v[self.num_agents:] = 0
-        # # Concatenate p v th
-        agent_states = np.concatenate([p, v, th[:, np.newaxis]], axis=1)  # (num_agents_max, 5)
+        agent_states[:n, :2] = self.np_random.uniform(-l2, l2, size=(n, 2))
+        agent_states[:n, 4] = self.np_random.uniform(-np.pi, np.pi, size=(n,))
+        np.cos(agent_states[:n, 4], out=agent_states[:n, 2])
+        np.sin(agent_states[:n, 4], out=agent_states[:n, 3])
+        agent_states[:n, 2:4] *= self.config.control.speed
 
         neighbor_masks, _ = self.update_network_topology(agent_states, padding_mask, init=True)
+        self._set_fixed_neighbor_masks(neighbor_masks)
 
-        self.state = {"agent_states": agent_states, "neighbor_masks": neighbor_masks, "padding_mask": padding_mask}
+        self.state = {"agent_states": agent_states, "neighbor_masks": neighbor_masks, "padding_mask": padding_mask,
+                      "padding_mask_2d": padding_mask_2d}
         self.has_lost_comm = False
 
         # Get relative state
@@ -382,17 +733,22 @@ class LazyControlFlockingEnv(gym.Env):
 
         # Get obs
         obs = self.get_obs(state=self.state, rel_state=self.rel_state, control_inputs=np.zeros(self.num_agents_max))
+        self._step_constants = self._get_step_constants()
 
         # Historical data
         self.alignment_hist = np.zeros(self.config.env.max_time_steps)
         self.spatial_entropy_hist = np.zeros(self.config.env.max_time_steps)
         self.velocity_entropy_hist = np.zeros(self.config.env.max_time_steps)
+        self._alignment_window = _SlidingWindowExtrema(self.config.env.alignment_window_length)
+        self._spatial_entropy_window = _SlidingWindowExtrema(self.config.env.entropy_rate_window_length)
+        self._velocity_entropy_window = _SlidingWindowExtrema(self.config.env.entropy_rate_window_length)
 
         # Other settings
         if self.config.env.get_state_hist:
-            self.agent_states_hist = np.zeros((self.config.env.max_time_steps, self.num_agents_max, 5))
-            self.neighbor_masks_hist = np.zeros((self.config.env.max_time_steps, self.num_agents_max, self.num_agents_max))
-            self.initial_state = self.state
+            # Same float32 as the live state, so step() can integrate straight into these rows
+            self.agent_states_hist = np.zeros((self.config.env.max_time_steps, self.num_agents_max, 5), dtype=np.float32)
+            self.neighbor_masks_hist = np.zeros((self.config.env.max_time_steps, self.num_agents_max, self.num_agents_max), dtype=np.bool_)
+            self.initial_state = {key: value.copy() for key, value in self.state.items()}  # snapshot, not an alias
         if self.config.env.get_action_hist:
             self.action_hist = np.zeros((self.config.env.max_time_steps, self.num_agents_max, self.num_agents_max), dtype=np.bool_)
 
@@ -406,17 +762,33 @@ class LazyControlFlockingEnv(gym.Env):
         """
         state = self.state  # state of the class (flock);
         rel_state = self.rel_state  # did NOT consider the communication network, DELIBERATELY
+        # Hoist the config lookups used below (each is an attribute chain through two pydantic models)
+        env_cfg = self.config.env
+        task_type = env_cfg.task_type
+        time_step = self.time_step
 
         # Interpret the action (i.e. model output)
         action_interpreted = self.interpret_action(model_output=action)  # (num_agents_max, )
-        joint_action = self.multi_to_single(action_interpreted) if self.config.env.env_mode == "multi_env" \
-            else action_interpreted
+        joint_action = self._to_joint_action(action_interpreted)
         joint_action = self.validate_action(action=joint_action,
                                             neighbor_masks=state["neighbor_masks"], padding_mask=state["padding_mask"])
 
+        # With the history on, the transition writes the next state straight into this step's history rows
+        out_agent_states, out_neighbor_masks = None, None
+        if env_cfg.get_state_hist:
+            out_neighbor_masks = self.neighbor_masks_hist[time_step]
+            if self.agent_states_hist.dtype == state["agent_states"].dtype:
+                out_agent_states = self.agent_states_hist[time_step]
+        integrates_into_hist = out_agent_states is not None
+        if not integrates_into_hist:
+            # Without the history, env.state["agent_states"] is overwritten two steps later; copy it to keep it
+            buf_a, buf_b = self._agent_states_bufs
+            out_agent_states = buf_b if state["agent_states"] is buf_a else buf_a
+
         # Step the environment in *single agent* setting!, which may be faster due to vectorization-like things
         # # s` = T(s, a)
-        next_state, control_inputs, comm_loss_agents = self.env_transition(state, rel_state, joint_action)
+        next_state, control_inputs, comm_loss_agents = self.env_transition(
+            state, rel_state, joint_action, out_agent_states=out_agent_states, out_neighbor_masks=out_neighbor_masks)
         next_rel_state = self.get_relative_state(state=next_state)
         # # r = R(s, a, s`)
         rewards = self._compute_rewards(
@@ -429,72 +801,75 @@ class LazyControlFlockingEnv(gym.Env):
                                               comm_loss_agents=comm_loss_agents)
 
         # Get custom reward if implemented
-        custom_reward = self.compute_custom_reward(state, rel_state, control_inputs, rewards, done)
-        _reward = rewards.sum() / self.num_agents if self.config.env.env_mode == "single_env" else self.single_to_multi(rewards)
+        custom_reward = self._custom_reward(state, rel_state, control_inputs, rewards, done)
+        _reward = self._reduce_rewards(rewards)
         reward = custom_reward if custom_reward is not NotImplemented else _reward
 
         # Collect info
+        is_acs = task_type == "acs"
         info = {
-            "spatial_entropy": self.spatial_entropy_hist[self.time_step] if self.config.env.task_type == "acs" else None,
-            "velocity_entropy": self.velocity_entropy_hist[self.time_step] if self.config.env.task_type == "acs" else None,
-            "alignment": self.alignment_hist[self.time_step] if self.config.env.task_type == "vicsek" else None,
+            "spatial_entropy": self.spatial_entropy_hist[time_step] if is_acs else None,
+            "velocity_entropy": self.velocity_entropy_hist[time_step] if is_acs else None,
+            "alignment": self.alignment_hist[time_step] if task_type == "vicsek" else None,
             "original_reward": _reward,
             "comm_loss_agents": comm_loss_agents,
         }
         info = self.get_extra_info(info, next_state, next_rel_state, control_inputs, rewards, done)
-        if self.config.env.get_state_hist:
-            self.agent_states_hist[self.time_step] = next_state["agent_states"]
-            self.neighbor_masks_hist[self.time_step] = next_state["neighbor_masks"]
-        if self.config.env.get_action_hist:
-            self.action_hist[self.time_step] = joint_action
+        if env_cfg.get_state_hist and not integrates_into_hist:  # states not integrated in place (dtype differs)
+            self.agent_states_hist[time_step] = next_state["agent_states"]
+        if env_cfg.get_action_hist:
+            self.action_hist[time_step] = joint_action
 
         # Update self.state and the self.rel_state
         self.state = next_state
         self.rel_state = next_rel_state
         # Update time steps
-        self.time_step += 1
+        self.time_step = time_step + 1
         # self.agent_time_step[state["padding_mask"]] += 1
         return obs, reward, done, info
 
     def get_relative_state(self, state):
         """
         Get the relative state (positions, velocities, headings, distances) from the absolute state
+        All pairwise differences are computed in a single broadcast over the agent states (no per-quantity passes)
         """
-        agent_positions = state["agent_states"][:, :2]
-        agent_velocities = state["agent_states"][:, 2:4]
-        agent_headings = state["agent_states"][:, 4, np.newaxis]  # shape (num_agents_max, 1): 2-D array
-        # neighbor_masks = state["neighbor_masks"]  # shape (num_agents_max, num_agents_max)
-        padding_mask = state["padding_mask"]  # shape (num_agents_max)
+        agent_states = state["agent_states"]  # (num_agents_max, 5)
+        padding_mask_2d = state["padding_mask_2d"]  # shape (num_agents_max, num_agents_max)
+        num_agents_max = agent_states.shape[0]
+
+        # Get relative agent states in one pass: rel_agent_states[i, j] = agent_states[j] - agent_states[i]
+        rel_agent_states = np.empty((num_agents_max, num_agents_max, 5), dtype=np.float32)
+        np.subtract(agent_states[np.newaxis, :, :], agent_states[:, np.newaxis, :], out=rel_agent_states)
+        # Remove padding agents (make zero); in-place multiply writes to the base array without temporaries
+        rel_agent_states *= padding_mask_2d[:, :, np.newaxis]
+        rel_agent_positions = rel_agent_states[:, :, :2]   # (num_agents_max, num_agents_max, 2)
+        rel_agent_velocities = rel_agent_states[:, :, 2:4]  # (num_agents_max, num_agents_max, 2)
+        rel_agent_headings = rel_agent_states[:, :, 4]      # (num_agents_max, num_agents_max)
 
         # Get relative positions and distances
         if self.config.env.periodic_boundary:
             l = self.config.control.initial_position_bound
-            # Get relative positions in normal boundary
-            rel_agent_positions, _ = self.get_relative_info(
-                data=agent_positions, mask=padding_mask, get_dist=False, get_active_only=False)
-            # Transform the relative positions to the periodic boundary
-            rel_agent_positions, rel_agent_dists = get_rel_pos_dist_in_periodic_boundary(
-                rel_pos_normal=rel_agent_positions, width=l, height=l)
-            # Remove padding agents (make zero)
-            rel_agent_positions[~padding_mask, :, :][:, ~padding_mask, :] = 0  # (num_agents_max, num_agents_max, 2)
-            rel_agent_dists[~padding_mask, :][:, ~padding_mask] = 0  # (num_agents_max, num_agents_max)
-        else:
-            rel_agent_positions, rel_agent_dists = self.get_relative_info(
-                data=agent_positions, mask=padding_mask, get_dist=True, get_active_only=False)
-
-        # Get relative velocities
-        rel_agent_velocities, _ = self.get_relative_info(
-            data=agent_velocities, mask=padding_mask, get_dist=False, get_active_only=False)
-
-        # Get relative headings
-        _, rel_agent_headings = self.get_relative_info(
-            data=agent_headings, mask=padding_mask, get_dist=True, get_active_only=False)
+            # Transform the relative positions to the periodic boundary (minimum image), in place;
+            # padded pairs stay zero as round(0) == 0
+            wraps = np.empty_like(rel_agent_positions)
+            np.round(np.divide(rel_agent_positions, l, out=wraps), out=wraps)
+            wraps *= l
+            rel_agent_positions -= wraps  # (num_agents_max, num_agents_max, 2)
+        # einsum avoids materializing the (num_agents_max, num_agents_max, 2) squared temporary
+        rel_agent_dists = np.sqrt(np.einsum('ijk,ijk->ij', rel_agent_positions, rel_agent_positions))
+
+        # cos/sin of the absolute headings, O(N) trig once per step; the pairwise cos/sin(θ_j - θ_i) used by
+        # get_obs and the ACS alignment term follow from the angle-difference identities
+        heading_cos = np.cos(agent_states[:, 4])  # (num_agents_max, )
+        heading_sin = np.sin(agent_states[:, 4])  # (num_agents_max, )
 
         # rel_state: dict
         rel_state = {"rel_agent_positions": rel_agent_positions,
                      "rel_agent_velocities": rel_agent_velocities,
                      "rel_agent_headings": rel_agent_headings,
-                     "rel_agent_dists": rel_agent_dists
+                     "rel_agent_dists": rel_agent_dists,
+                     "heading_cos": heading_cos,
+                     "heading_sin": heading_sin,
                      }
 
         return rel_state
@@ -524,23 +899,23 @@ class LazyControlFlockingEnv(gym.Env):
         assert action.ndim == 1, "action must be a 1D dtype; got {}".format(action.ndim)
         assert action.shape[0] == num_agents_max, \
             "action must have shape (num_agents_max, ); got {}".format(action.shape)
-        # Range (check if all are in [0, 1])
-        if np.all(np.logical_and(action < 0, action > 1)):
-            print(f"Warning: action must be in [0, 1]; But got max={np.max(action)}, min={np.min(action)}")
-            action = np.clip(action, 0, 1)
+        # Range (check if all are in [0, 1]); two reductions, no temporary masks
+        action_min, action_max = action.min(), action.max()
+        if action_min < 0.0 or action_max > 1.0:
+            print(f"Warning: action must be in [0, 1]; But got max={action_max}, min={action_min}")
+            action = np.clip(action, 0.0, 1.0)  # new array: do not overwrite the caller's model output
             print(f"action is clipped to [0, 1]; max={np.max(action)}, min={np.min(action)}")
 
         return action
 
     def get_vicsek_action(self):
         neighbor_masks = self.state["neighbor_masks"]  # shape (num_agents_max, num_agents_max)
-        padding_mask = self.state["padding_mask"]  # shape (num_agents_max)
-        padding_mask_2d = padding_mask[:, np.newaxis] & padding_mask[np.newaxis, :]  # (num_agents_max, num_agents_max)
+        padding_mask_2d = self.state["padding_mask_2d"]  # shape (num_agents_max, num_agents_max)
 
         # Vicsek action: logical and between the neighbor_masks and the padding_mask_2d
         vicsek_action = neighbor_masks & padding_mask_2d  # (num_agents_max, num_agents_max)
-        # Make vicsek_action an integer subtype numpy array
-        vicsek_action = vicsek_action.astype(np.int8)
+        # Make vicsek_action an integer subtype numpy array; np.bool_ is 1 byte, so reinterpret instead of copying
+        vicsek_action = vicsek_action.view(np.int8)
 
         return vicsek_action
 
@@ -552,12 +927,20 @@ class LazyControlFlockingEnv(gym.Env):
         :return: variable_in_single: ndarray of shape (num_agents, data...)
         """
         # Add extra dimension of each agent's variable on axis=0
-        assert variable_in_multi[self.config.env.agent_name_prefix + str(0)].shape[0] == self.num_agents, \
+        assert variable_in_multi[self._agent_keys[0]].shape[0] == self.num_agents, \
             "num_agents must == variable_in_multi['agent_0'].shape[0]"
-        variable_in_single = np.array(variable_in_multi.values())  # (num_agents, ...)
+        variable_in_single = np.stack([variable_in_multi[key] for key in self._agent_keys])  # (num_agents, ...)
 
         return variable_in_single
 
+    def _mean_reward(self, rewards):
+        """
+        Reduces the per-agent rewards to the single-agent reward: mean over the active agents
+        :param rewards: (num_agents_max, ); zero for the padded agents
+        :return: reward (scalar)
+        """
+        return rewards.sum() / self.num_agents
+
     def single_to_multi(self, variable_in_single: np.ndarray):
         """
         Converts a single-agent variable to a multi-agent variable
@@ -565,43 +948,63 @@ class LazyControlFlockingEnv(gym.Env):
         :param variable_in_single: ndarray of shape (num_agents, data...)
         :return: variable_in_multi
         """
-        # Remove the extra dimension of each agent's variable on axis=0 and use self.agent_name_suffix with i as keys
-        variable_in_multi = {}
+        # Remove the extra dimension of each agent's variable on axis=0 and use the cached agent names as keys
         assert variable_in_single.shape[0] == self.num_agents_max, "variable_in_single[0] must be self.num_agents_max"
-        for i in range(self.num_agents_max):
-            variable_in_multi[self.config.env.agent_name_prefix + str(i)] = variable_in_single[i]
+        variable_in_multi = dict(zip(self._agent_keys, variable_in_single))
 
         return variable_in_multi
 
-    def env_transition(self, state, rel_state, action):
+    def env_transition(self, state, rel_state, action, out_agent_states=None, out_neighbor_masks=None):
         """
         Transition the environment; all args in single-rl-agent settings
         s` = T(s, a); deterministic
         :param state: dict:
         :param rel_state: dict:
         :param action: ndarray of shape (num_agents_max,)
+        :param out_agent_states: (optional) buffer the next agent states are integrated into (e.g. a history row)
+        :param out_neighbor_masks: (optional) buffer the next neighbor masks are written into (e.g. a history row)
         :return: next_state: dict; control_inputs: (num_agents_max, )
         """
         # Validate the laziness_vectors
         # self.validate_action(action=action, neighbor_masks=state["neighbor_masks"], padding_mask=state["padding_mask"])
 
-        # 1. Get control inputs based on the flocking control algorithm with the lazy listener's network
-        if self.config.env.task_type == "vicsek":
-            control_inputs = self.get_vicsek_control(state, rel_state, state["neighbor_masks"])  # (num_agents_max, )
-        elif self.config.env.task_type == "acs":
-            control_inputs = self.get_acs_control(state, rel_state, state["neighbor_masks"])  # (num_agents_max, )
+        padding_mask = state["padding_mask"]
+
+        c = self._step_constants
+        if c is not None:
+            # 1.-3. in one compiled call (see _get_step_constants for when this applies)
+            if out_agent_states is None:
+                out_agent_states = np.empty((self.num_agents_max, 5), dtype=np.float32)
+            next_agent_states, control_inputs = _step_core(
+                state["agent_states"], rel_state["rel_agent_positions"], rel_state["rel_agent_dists"],
+                rel_state["rel_agent_velocities"], rel_state["rel_agent_headings"], rel_state["heading_cos"],
+                rel_state["heading_sin"], state["neighbor_masks"], padding_mask, action, c,
+                self._control_inputs_buf, np.empty(self.num_agents_max, dtype=np.float32), out_agent_states)
         else:
-            raise NotImplementedError("task_type must be either vicsek or acs")
+            # 1. Get control inputs based on the flocking control algorithm with the lazy listener's network
+            # # get_acs_control or get_vicsek_control, bound in __init__ by task_type
+            control_inputs = self._get_control(state, rel_state, state["neighbor_masks"])  # (num_agents_max, )
 
-        # # 2. Apply lazy control actions: alters the control_inputs!
-        control_inputs = (1 - action) * control_inputs
+            # # 2. Apply lazy control actions: alters the control_inputs!
+            control_inputs = (1 - action) * control_inputs
 
-        # 3. Update the agent states based on the control inputs
-        next_agent_states = self.update_agent_states(state=state, control_inputs=control_inputs)
+            # 3. Update the agent states based on the control inputs
+            next_agent_states = self.update_agent_states(
+                state=state, control_inputs=control_inputs, out=out_agent_states)
 
         # 4. Update network topology (i.e. neighbor_masks) based on the new agent states
-        next_neighbor_masks, comm_loss_agents = self.update_network_topology(
-            next_agent_states=next_agent_states, padding_mask=state["padding_mask"], init=False)
+        if self.config.env.comm_range is None:
+            # Fixed topology (fully-connected or custom): set in reset() and never changes; a new array (or the
+            # history row) per step from the private template, so an obs kept or edited in place aliases no other step
+            comm_loss_agents = None
+            if out_neighbor_masks is not None:
+                np.copyto(out_neighbor_masks, self._fixed_neighbor_masks)
+                next_neighbor_masks = out_neighbor_masks
+            else:
+                next_neighbor_masks = self._fixed_neighbor_masks.copy()
+        else:
+            next_neighbor_masks, comm_loss_agents = self.update_network_topology(
+                next_agent_states=next_agent_states, padding_mask=padding_mask, init=False, out=out_neighbor_masks)
 
         # 5. Update the active agents (i.e. padding_mask); you may lose or gain agents
         # next_padding_mask = self.update_active_agents(
@@ -611,17 +1014,49 @@ class LazyControlFlockingEnv(gym.Env):
         # 6. Update the state
         next_state = {"agent_states": next_agent_states,
                       "neighbor_masks": next_neighbor_masks,
-                      "padding_mask": state["padding_mask"]
+                      "padding_mask": padding_mask,
+                      "padding_mask_2d": state["padding_mask_2d"],
                       }
 
         return next_state, control_inputs, comm_loss_agents
 
-    def update_network_topology(self, next_agent_states, padding_mask, init=False):
+    def _set_fixed_neighbor_masks(self, neighbor_masks):
+        """
+        Keeps a read-only copy of the initial neighbor masks as the template env_transition carries forward
+        while the topology is fixed (comm_range is None); None otherwise
+        :param neighbor_masks: (num_agents_max, num_agents_max) initial neighbor masks
+        """
+        if self.config.env.comm_range is None:
+            self._fixed_neighbor_masks = neighbor_masks.copy()
+            self._fixed_neighbor_masks.setflags(write=False)
+        else:
+            self._fixed_neighbor_masks = None
+
+    def _get_step_constants(self):
+        """
+        Unpacks the config scalars used by _step_core; called once per reset
+        :return: _StepConstants, or None to step through the Python methods (no numba, or a subclass overrides
+                 the control or the state update)
+        """
+        cls = type(self)
+        if not NUMBA_AVAILABLE or any(getattr(cls, name) is not getattr(LazyControlFlockingEnv, name) for name in
+                                      ("get_acs_control", "get_vicsek_control", "update_agent_states")):
+            return None
+        ctl, env = self.config.control, self.config.env
+        is_acs = env.task_type == "acs"
+        return _StepConstants(
+            is_acs=is_acs, beta=float(ctl.beta), psi_mode=self._psi_mode if is_acs else _PSI_GENERAL,
+            lam=float(ctl.lam), sig=float(ctl.sig), k1=float(ctl.k1), k2=float(ctl.k2), r0=float(ctl.r0),
+            speed=float(ctl.speed), u_max=float(ctl.max_turn_rate), dt=float(env.dt),
+            periodic=bool(env.periodic_boundary), bound=float(ctl.initial_position_bound))
+
+    def update_network_topology(self, next_agent_states, padding_mask, init=False, out=None):
         """
         Update the network topology based on the new agent states
         :param next_agent_states: ndarray of shape (num_agents_max, 5)
         :param padding_mask: ndarray of shape (num_agents_max,)
-        :return: next_neighbor_masks: ndarray of shape (num_agents_max, num_agents_max)
+        :param out: (optional) bool ndarray of shape (num_agents_max, num_agents_max) to write the masks into
+        :return: next_neighbor_masks: ndarray of shape (num_agents_max, num_agents_max); *out* if given
         """
         if self.config.env.comm_range is None:
             if self.config.env.enable_custom_topology:
@@ -642,14 +1077,18 @@ class LazyControlFlockingEnv(gym.Env):
         else:
             next_neighbor_masks, comm_loss_agents = self.compute_neighbor_agents(
                 agent_states=next_agent_states, padding_mask=padding_mask,
-                communication_range=self.config.env.comm_range)
+                communication_range=self.config.env.comm_range, out=out)
+
+        if out is not None and next_neighbor_masks is not out:
+            np.copyto(out, next_neighbor_masks)
+            next_neighbor_masks = out
 
         return next_neighbor_masks, comm_loss_agents
 
     def get_vicsek_control(self, state, rel_state, new_network):
         """
         Get the control inputs based on the agent states using the Vicsek Model
-        :return: u (num_agents_max)
+        :return: u (num_agents_max); a per-env buffer, overwritten by the next call
         """
         # Please Work with Active Agents Only
 
@@ -662,39 +1101,39 @@ class LazyControlFlockingEnv(gym.Env):
         padding_mask = state["padding_mask"]  # (num_agents_max)
         neighbor_masks = new_network  # (num_agents_max, num_agents_max)
 
-        # Get data of the active agents
-        active_agents_indices = np.nonzero(padding_mask)[0]  # (num_agents, )
-        active_agents_indices_2d = np.ix_(active_agents_indices, active_agents_indices)  # (num_agents,num_agents)
-        # p = rel_pos[active_agents_indices_2d]  # (num_agents, num_agents, 2)
-        # r = rel_dist[active_agents_indices_2d] + (
-        #             np.eye(self.num_agents) * np.finfo(float).eps)  # (num_agents, num_agents)
-        # v = rel_vel[active_agents_indices_2d]  # (num_agents, num_agents, 2)
-        th = rel_ang[active_agents_indices_2d]  # (num_agents, num_agents)
-        # th_i = abs_ang[padding_mask]  # (num_agents, )
-        net = neighbor_masks[active_agents_indices_2d]  # (num_agents, num_agents) might: no self-loops (i.e. 0 on diag)
-        n = (net + (np.eye(self.num_agents) * np.finfo(float).eps)).sum(axis=1)  # (num_agents, )
-
-        # Get control for Vicsek Model
-        relative_heading_network_filtered = th * net  # (num_agents, num_agents)
-        average_heading = relative_heading_network_filtered.sum(axis=1) / n  # (num_agents, )
-        average_heading_rate = average_heading / self.config.env.dt  # (num_agents, )
-
         # Get control config
         u_max = self.config.control.max_turn_rate
 
-        # 3. Saturation
-        u_active = np.clip(average_heading_rate, -u_max, u_max)  # (num_agents, )
+        if NUMBA_AVAILABLE:
+            # The kernel skips the padded agents itself; no active-agent gather or padding pass needed
+            return _vicsek_control_kernel(rel_ang, neighbor_masks, padding_mask, self.config.env.dt, u_max,
+                                          self._control_inputs_buf)
 
-        # 4. Padding
-        u = np.zeros(self.num_agents_max, dtype=np.float32)  # (num_agents_max, )
-        u[padding_mask] = u_active  # (num_agents_max, )
+        # Work on the padded arrays directly: the padded pairs are masked out of the network, so their rows sum to 0
+        th = rel_ang  # (num_agents_max, num_agents_max)
+        net = neighbor_masks & state["padding_mask_2d"]  # (num_agents_max, num_agents_max) might: no self-loops
+
+        n = net.sum(axis=1, dtype=np.float32) + np.finfo(float).eps  # (num_agents_max, ); eps keeps padded rows off 0/0
+
+        # Get control for Vicsek Model
+        rows, cols = np.nonzero(net)  # (num_edges, )
+        if rows.size <= _SPARSE_NET_MAX_DENSITY * self.num_agents**2:  # sparse network: sum over the edges only
+            heading_sum = np.bincount(rows, weights=th[rows, cols], minlength=self.num_agents_max)
+        else:
+            relative_heading_network_filtered = th * net  # (num_agents_max, num_agents_max)
+            heading_sum = relative_heading_network_filtered.sum(axis=1)  # (num_agents_max, )
+        average_heading = heading_sum / n  # (num_agents_max, )
+        average_heading_rate = average_heading / self.config.env.dt  # (num_agents_max, )
+
+        # 3. Saturation; the padded agents are already 0
+        u = np.clip(average_heading_rate, -u_max, u_max, out=self._control_inputs_buf)  # (num_agents_max, )
 
         return u
 
     def get_acs_control(self, state, rel_state, new_network):
         """
         Get the control inputs based on the agent states using the ACS Model
-        :return: u (num_agents_max)
+        :return: u (num_agents_max); a per-env buffer, overwritten by the next call
         """
         """
         Get the control inputs based on the agent states
@@ -706,22 +1145,11 @@ class LazyControlFlockingEnv(gym.Env):
         rel_pos = rel_state["rel_agent_positions"]   # (num_agents_max, num_agents_max, 2)
         rel_dist = rel_state["rel_agent_dists"]      # (num_agents_max, num_agents_max)
         rel_vel = rel_state["rel_agent_velocities"]  # (num_agents_max, num_agents_max, 2)
-        rel_ang = rel_state["rel_agent_headings"]    # (num_agents_max, num_agents_max)
-        abs_ang = state["agent_states"][:, 4]        # (num_agents_max, )
+        cos_ang = rel_state["heading_cos"]           # (num_agents_max, )
+        sin_ang = rel_state["heading_sin"]           # (num_agents_max, )
         padding_mask = state["padding_mask"]         # (num_agents_max)
         neighbor_masks = new_network  # (num_agents_max, num_agents_max)
 
-        # Get data of the active agents
-        active_agents_indices = np.nonzero(padding_mask)[0]  # (num_agents, )
-        active_agents_indices_2d = np.ix_(active_agents_indices, active_agents_indices)  # (num_agents,num_agents)
-        p = rel_pos[active_agents_indices_2d]  # (num_agents, num_agents, 2)
-        r = rel_dist[active_agents_indices_2d] + (np.eye(self.num_agents)*np.finfo(float).eps) #(num_agents, num_agents)
-        v = rel_vel[active_agents_indices_2d]  # (num_agents, num_agents, 2)
-        th = rel_ang[active_agents_indices_2d]  # (num_agents, num_agents)
-        th_i = abs_ang[padding_mask]  # (num_agents, )
-        net = neighbor_masks[active_agents_indices_2d]  # (num_agents, num_agents) may be no self-loops (i.e. 0 on diag)
-        N = (net + (np.eye(self.num_agents) * np.finfo(float).eps)).sum(axis=1)  # (num_agents, )
-
         # Get control config
         beta = self.config.control.beta
         lam = self.config.control.lam
@@ -732,14 +1160,37 @@ class LazyControlFlockingEnv(gym.Env):
         r0 = self.config.control.r0
         sig = self.config.control.sig
 
+        if NUMBA_AVAILABLE:
+            # The kernel skips the padded agents itself; no active-agent gather or padding pass needed
+            return _acs_control_kernel(rel_pos, rel_dist, rel_vel, cos_ang, sin_ang, neighbor_masks, padding_mask,
+                                       beta, self._psi_mode, lam, sig, k1, k2, r0, spd, u_max, self._control_inputs_buf)
+
+        # Work on the padded arrays directly: the padded pairs are masked out of the network
+        p = rel_pos  # (num_agents_max, num_agents_max, 2)
+        v = rel_vel  # (num_agents_max, num_agents_max, 2)
+        net = neighbor_masks & state["padding_mask_2d"]  # (num_agents_max, num_agents_max) may be no self-loops
+
+        # Sparse network (e.g. a short comm_range): evaluate only the neighbor pairs instead of the dense N^2 terms
+        rows, cols = np.nonzero(net)  # (num_edges, ), row-major
+        if rows.size <= _SPARSE_NET_MAX_DENSITY * self.num_agents**2:
+            return self._get_acs_control_sparse(rows, cols, rel_pos, rel_dist, rel_vel, cos_ang, sin_ang,
+                                                beta, lam, sig, k1, k2, r0, spd, u_max)
+
+        # Non-neighbor pairs (incl. the padded ones) get r=1 so the 1/r terms stay finite before the net mask
+        r = np.where(net, rel_dist, 1.0)  # (num_agents_max, num_agents_max); float32 like rel_dist
+        r.flat[::self.num_agents_max + 1] += np.finfo(float).eps  # self-loops (2.2e-16 is a normal float32)
+        N = net.sum(axis=1, dtype=np.float32) + np.finfo(float).eps  # (num_agents_max, ); keeps padded rows off 0/0
+
         # 1. Compute Alignment Control Input
         # # u_cs = (lambda/n(N_i)) * sum_{j in N_i}[ psi(r_ij)sin(θ_j - θ_i) ],
         # # where N_i is the set of neighbors of agent i,
         # # psi(r_ij) = 1/(1+r_ij^2)^(beta),
         # # r_ij = ||X_j - X_i||, X_i = (x_i, y_i),
-        psi = (1 + r**2)**(-beta)  # (num_agents, num_agents)
-        alignment_error = np.sin(th)  # (num_agents, num_agents)
-        u_cs = (lam / N) * (psi * alignment_error * net).sum(axis=1)  # (num_agents, )
+        psi = _compute_psi(r**2, beta, self._psi_mode)  # (num_agents_max, num_agents_max)
+        # sin(θ_j - θ_i) = sin(θ_j)cos(θ_i) - cos(θ_j)sin(θ_i); no per-pair trig
+        alignment_error = (sin_ang[np.newaxis, :] * cos_ang[:, np.newaxis]
+                           - cos_ang[np.newaxis, :] * sin_ang[:, np.newaxis])  # (num_agents_max, num_agents_max)
+        u_cs = (lam / N) * (psi * alignment_error * net).sum(axis=1)  # (num_agents_max, )
 
         # 2. Compute Cohesion and Separation Control Input
         # # u_coh[i] = (sigma/N*V)
@@ -754,25 +1205,65 @@ class LazyControlFlockingEnv(gym.Env):
         # # r_ij = ||X_j - X_i||, X_i = (x_i, y_i),
         # # rel_vel = (vx_j - vx_i, vy_j - vy_i),
         # # rel_pos = (x_j - x_i, y_j - y_i),
-        sig_NV = sig / (N * spd)  # (num_agents, )
-        k1_2r2 = k1 / (2 * r**2)  # (num_agents, num_agents)
-        k2_2r = k2 / (2 * r)  # (num_agents, num_agents)
-        v_dot_p = np.einsum('ijk,ijk->ij', v, p)  # (num_agents, num_agents)
-        r_minus_r0 = r - r0  # (num_agents, num_agents)
-        sin_th_i = -np.sin(th_i)  # (num_agents, )
-        cos_th_i = np.cos(th_i)   # (num_agents, )
-        dir_dot_p = sin_th_i[:, np.newaxis]*p[:, :, 0] + cos_th_i[:, np.newaxis]*p[:, :, 1]  # (num_agents, num_agents)
-        u_coh = sig_NV * np.sum((k1_2r2 * v_dot_p + k2_2r * r_minus_r0) * dir_dot_p * net, axis=1)  # (num_agents, )
-
-        # 3. Saturation
-        u_active = np.clip(u_cs + u_coh, -u_max, u_max)  # (num_agents, )
-
-        # 4. Padding
-        u = np.zeros(self.num_agents_max, dtype=np.float32)  # (num_agents_max, )
-        u[padding_mask] = u_active  # (num_agents_max, )
+        sig_NV = sig / (N * spd)  # (num_agents_max, )
+        k1_2r2 = k1 / (2 * r**2)  # (num_agents_max, num_agents_max)
+        k2_2r = k2 / (2 * r)  # (num_agents_max, num_agents_max)
+        v_dot_p = v[:, :, 0] * p[:, :, 0] + v[:, :, 1] * p[:, :, 1]  # (num_agents_max, num_agents_max); no einsum planning
+        r_minus_r0 = r - r0  # (num_agents_max, num_agents_max)
+        sin_th_i = -sin_ang  # (num_agents_max, )
+        cos_th_i = cos_ang   # (num_agents_max, )
+        dir_dot_p = sin_th_i[:, np.newaxis]*p[:, :, 0] + cos_th_i[:, np.newaxis]*p[:, :, 1]  # (num_agents_max, num_agents_max)
+        u_coh = sig_NV * np.sum((k1_2r2 * v_dot_p + k2_2r * r_minus_r0) * dir_dot_p * net, axis=1)  # (num_agents_max, )
+
+        # 3. Saturation; the padded agents are already 0
+        u = np.clip(u_cs + u_coh, -u_max, u_max, out=self._control_inputs_buf)  # (num_agents_max, )
 
         return u
 
+    def _get_acs_control_sparse(self, rows, cols, rel_pos, rel_dist, rel_vel, cos_ang, sin_ang,
+                                beta, lam, sig, k1, k2, r0, spd, u_max):
+        """
+        ACS control inputs over the edge list of the network (numpy path); same terms as get_acs_control
+        :param rows: (num_edges, ) agent i of each neighbor pair (i, j)
+        :param cols: (num_edges, ) agent j of each neighbor pair (i, j)
+        :return: u (num_agents_max)
+        """
+        num_agents_max = self.num_agents_max
+        eps = np.finfo(float).eps
+        p = rel_pos[rows, cols]  # (num_edges, 2)
+        v = rel_vel[rows, cols]  # (num_edges, 2)
+        r = rel_dist[rows, cols]  # (num_edges, )
+        r[rows == cols] += eps  # self-loops
+        N = np.bincount(rows, minlength=num_agents_max) + eps  # (num_agents_max, )
+
+        # 1. Alignment
+        psi = _compute_psi(r**2, beta, self._psi_mode)  # (num_edges, )
+        cos_i, sin_i, cos_j, sin_j = cos_ang[rows], sin_ang[rows], cos_ang[cols], sin_ang[cols]  # (num_edges, )
+        alignment_error = sin_j * cos_i - cos_j * sin_i  # sin(θ_j - θ_i)
+        u_cs = (lam / N) * np.bincount(rows, weights=psi * alignment_error, minlength=num_agents_max)
+
+        # 2. Cohesion and separation
+        v_dot_p = v[:, 0] * p[:, 0] + v[:, 1] * p[:, 1]  # (num_edges, )
+        dir_dot_p = -sin_i * p[:, 0] + cos_i * p[:, 1]  # (num_edges, )
+        coh = (k1 / (2 * r**2) * v_dot_p + k2 / (2 * r) * (r - r0)) * dir_dot_p  # (num_edges, )
+        u_coh = sig / (N * spd) * np.bincount(rows, weights=coh, minlength=num_agents_max)
+
+        # 3. Saturation; the padded agents have no edges, so they are 0
+        return np.clip(u_cs + u_coh, -u_max, u_max, out=self._control_inputs_buf)  # (num_agents_max, )
+
+    def get_active_agents_indices(self, padding_mask):
+        """
+        Returns the indices of the active agents and their np.ix_ pair index, recomputed only when a new
+        padding_mask array comes in (it is created on reset and carried through the steps unchanged)
+        :param padding_mask: (num_agents_max)
+        :return: active_agents_indices: (num_agents, ), active_agents_indices_2d: np.ix_ of them
+        """
+        if padding_mask is not self._indexed_padding_mask:
+            self._active_agents_indices = np.nonzero(padding_mask)[0]  # (num_agents, )
+            self._active_agents_indices_2d = np.ix_(self._active_agents_indices, self._active_agents_indices)
+            self._indexed_padding_mask = padding_mask
+        return self._active_agents_indices, self._active_agents_indices_2d
+
     @staticmethod
     def filter_active_agents_data(data, padding_mask):
         """
@@ -789,64 +1280,97 @@ class LazyControlFlockingEnv(gym.Env):
 
         return active_data
 
-    def update_agent_states(self, state, control_inputs):
+    def update_agent_states(self, state, control_inputs, out=None):
+        """
+        Integrates the agent states one step forward with the given control inputs
+        :param out: (optional) ndarray of shape (num_agents_max, 5) to write the next agent states into
+        :return: next_agent_states (num_agents_max, 5); *out* if given
+        """
         padding_mask = state["padding_mask"]
+        dt = self.config.env.dt
+        # Every column is written below straight into the float32 state buffer; no per-quantity arrays to concatenate
+        next_agent_states = np.empty((self.num_agents_max, 5), dtype=np.float32) if out is None else out
+
+        # Integrate the active agents only; reset/custom_reset pad at the tail, so they are a slice (no gather)
+        active_agents_indices, _ = self.get_active_agents_indices(padding_mask)
+        num_agents = active_agents_indices.size
+        is_tail_padding = active_agents_indices[-1] == num_agents - 1
+        active = slice(0, num_agents) if is_tail_padding else active_agents_indices
+        agent_states = state["agent_states"][active]  # (num_agents, 5)
 
         # 0. <- 3. Positions
-        next_agent_positions = (state["agent_states"][:, :2]
-                                + state["agent_states"][:, 2:4] * self.config.env.dt)  # (n_a_max, 2)
+        next_agent_positions = agent_states[:, :2] + agent_states[:, 2:4] * dt  # (num_agents, 2)
         if self.config.env.periodic_boundary:
             w = h = self.config.control.initial_position_bound
             next_agent_positions = wrap_to_rectangle(next_agent_positions, w, h)
+        next_agent_states[active, :2] = next_agent_positions
         # 1. Headings
-        next_agent_headings = state["agent_states"][:, 4] + control_inputs * self.config.env.dt  # (num_agents_max, )
-        # next_agent_headings = np.mod(next_agent_headings, 2 * np.pi)  # (num_agents_max, )
+        next_agent_headings = agent_states[:, 4] + control_inputs[active] * dt  # (num_agents, )
+        # next_agent_headings = np.mod(next_agent_headings, 2 * np.pi)  # (num_agents, )
+        next_agent_states[active, 4] = next_agent_headings
         # 2. Velocities
         v = self.config.control.speed
-        next_agent_velocities = np.zeros((self.num_agents_max, 2), dtype=np.float32)  # (num_agents_max, 2)
-        next_agent_velocities[padding_mask] = v * np.stack([np.cos(next_agent_headings[padding_mask]),
-                                                            np.sin(next_agent_headings[padding_mask])], axis=1)
+        if NUMBA_AVAILABLE:
+            if is_tail_padding:  # write straight into the state rows
+                _headings_to_velocities(next_agent_headings, v, next_agent_states[active, 2:4])
+            else:
+                next_agent_states[active, 2:4] = _headings_to_velocities(
+                    next_agent_headings, v, np.empty((num_agents, 2), dtype=np.float32))
+        else:
+            next_agent_states[active, 2] = np.cos(next_agent_headings)
+            next_agent_states[active, 3] = np.sin(next_agent_headings)
+            next_agent_states[active, 2:4] *= v
         # 3. Positions
         # next_agent_positions = state["agent_states"][:, :2] + next_agent_velocities * self.dt  # (num_agents_max, 2)
-        # 4. Concatenate
-        next_agent_states = np.concatenate(  # (num_agents_max, 5)
-            [next_agent_positions, next_agent_velocities, next_agent_headings[:, np.newaxis]], axis=1)
+        # The padded agents stay at zero
+        if is_tail_padding:
+            next_agent_states[num_agents:] = 0.0
+        else:
+            next_agent_states[~padding_mask] = 0.0
 
         return next_agent_states  # This did not update the neighbor_masks; it is done in the env_transition
 
-    def compute_neighbor_agents(self, agent_states, padding_mask, communication_range, includes_self_loops=True):
+    def compute_neighbor_agents(self, agent_states, padding_mask, communication_range, includes_self_loops=True,
+                                out=None):
         """
         1. Computes the neighbor matrix based on communication range
         2. Excludes the padding agents (i.e. mask_value==0)
         3. (By default) Includes the self-loops
+        If *out* (num_agents_max, num_agents_max) is given, the neighbor matrix is written into it
         """
-        self_loop = includes_self_loops  # True if includes self-loops; False otherwise
-        agent_positions = agent_states[:, :2]  # (num_agents_max, 2)
-        # Get active relative distances
+        active_agents_indices, _ = self.get_active_agents_indices(padding_mask)  # (num_agents, )
+        agent_positions = agent_states[active_agents_indices, :2]  # (num_agents, 2)
+        # Get the pairs of active agents within the communication range; O(N log N + k) with a KD-tree
         if self.config.env.periodic_boundary:
-            rel_pos_normal, _ = self.get_relative_info(data=agent_positions, mask=padding_mask,
-                                                       get_dist=False, get_active_only=True)
-            width = height = self.config.control.initial_position_bound
-            _, rel_dist = get_rel_pos_dist_in_periodic_boundary(rel_pos_normal, width, height)
+            l = self.config.control.initial_position_bound
+            # The periodic KD-tree needs coordinates in [0, l); the agent positions are wrapped to [-l/2, l/2)
+            agent_positions = np.mod(agent_positions + l / 2, l)
+            agent_positions[agent_positions >= l] = 0.0  # np.mod may round tiny negatives up to l
+            tree = cKDTree(agent_positions, boxsize=l, balanced_tree=False, compact_nodes=False)
         else:
-            _, rel_dist = self.get_relative_info(data=agent_positions, mask=padding_mask,
-                                                 get_dist=True, get_active_only=True)
+            # The tree is rebuilt every step, so take the cheaper sliding-midpoint build (no median search/shrink)
+            tree = cKDTree(agent_positions, balanced_tree=False, compact_nodes=False)
+        pairs = tree.query_pairs(r=communication_range, output_type='ndarray')  # (num_pairs, 2); distance <= range
 
-        # Get active neighbor masks
-        active_neighbor_masks = rel_dist <= communication_range  # (num_agents, num_agents)
-        if not includes_self_loops:
-            np.fill_diagonal(active_neighbor_masks, self_loop)  # Set the diagonal to 0 if the mask don't include loops
         # Get the next neighbor masks
-        next_neighbor_masks = np.zeros((self.num_agents_max, self.num_agents_max),
-                                       dtype=np.bool_)  # (num_agents_max, num_agents_max)
-        active_agents_indices = np.nonzero(padding_mask)[0]  # (num_agents, )
-        next_neighbor_masks[np.ix_(active_agents_indices, active_agents_indices)] = active_neighbor_masks
-
-        # Check no neighbor agents (be careful neighbor mask may not include self-loops)
-        neighbor_nums = next_neighbor_masks.sum(axis=1)  # (num_agents_max, )
-        if not includes_self_loops:
-            neighbor_nums += 1  # Add 1 for artificial self-loops
-        comm_loss_agents = np.logical_and(padding_mask, neighbor_nums == 1)  # is alone in the network?
+        if out is None:
+            next_neighbor_masks = np.zeros((self.num_agents_max, self.num_agents_max),
+                                           dtype=np.bool_)  # (num_agents_max, num_agents_max)
+        else:
+            next_neighbor_masks = out
+            next_neighbor_masks.fill(False)
+        i, j = active_agents_indices[pairs[:, 0]], active_agents_indices[pairs[:, 1]]
+        next_neighbor_masks[i, j] = True
+        next_neighbor_masks[j, i] = True  # symmetric
+        if includes_self_loops:
+            next_neighbor_masks[active_agents_indices, active_agents_indices] = True
+
+        # Check no neighbor agents: an active agent in no pair is alone in the network (with or without self-loops);
+        # O(num_pairs) over the pair list instead of an O(N^2) row sum of the masks
+        has_neighbor = np.zeros(self.num_agents_max, dtype=np.bool_)  # (num_agents_max, )
+        has_neighbor[i] = True
+        has_neighbor[j] = True
+        comm_loss_agents = padding_mask & ~has_neighbor  # is alone in the network?
 
         return next_neighbor_masks, comm_loss_agents  # (num_agents_max, num_agents_max), (num_agents_max)
 
@@ -880,7 +1404,7 @@ class LazyControlFlockingEnv(gym.Env):
             active_agents_indices = np.nonzero(padding_mask)[0]
             neighbor_masks[np.ix_(active_agents_indices, active_agents_indices)] = active_neighbor_masks
 
-            self.fixed_topology_info = copy.deepcopy(neighbor_masks)  # Save the fixed topology info
+            self.fixed_topology_info = neighbor_masks.copy()  # Save the fixed topology info
 
         comm_loss_agents = None  # No communication loss in line topology
 
@@ -922,7 +1446,7 @@ class LazyControlFlockingEnv(gym.Env):
             neighbor_masks[np.ix_(active_indices, active_indices)] = active_neighbor_masks
 
             # Cache fixed topology
-            self.fixed_topology_info = copy.deepcopy(neighbor_masks)
+            self.fixed_topology_info = neighbor_masks.copy()
 
         comm_loss_agents = None  # No agents are disconnected in star topology
 
@@ -954,19 +1478,21 @@ class LazyControlFlockingEnv(gym.Env):
         # rel_data: shape (num_agents_max, num_agents_max, data_dim); rel_data[i, j] = data[j] - data[i]
         # rel_data_active: shape (num_agents, num_agents, data_dim)
         # rel_data_active := data[mask] - data[mask, np.newaxis, :]
-        rel_data_active = data[np.newaxis, mask, :] - data[mask, np.newaxis, :]
         if get_active_only:
-            rel_data = rel_data_active
+            active_data = data[mask]  # (num_agents, data_dim)
+            rel_data = active_data[np.newaxis, :, :] - active_data[:, np.newaxis, :]
         else:
-            rel_data = np.zeros((self.num_agents_max, self.num_agents_max, data_dim), dtype=np.float32)
-            rel_data[np.ix_(mask, mask, np.arange(data_dim))] = rel_data_active
-            # rel_data[mask, :, :][:, mask, :] = rel_data_active  # not sure; maybe 2-D array (not 3-D) if num_true = 1
+            # Subtract over the padded data in one broadcast and zero the padded pairs in place;
+            # no active-sized temporary scattered back through np.ix_
+            rel_data = np.empty((self.num_agents_max, self.num_agents_max, data_dim), dtype=np.float32)
+            np.subtract(data[np.newaxis, :, :], data[:, np.newaxis, :], out=rel_data, casting="same_kind")
+            rel_data *= (mask[:, np.newaxis] & mask[np.newaxis, :])[:, :, np.newaxis]
 
         # Compute relative distances
         # rel_dist: shape (num_agents_max, num_agents_max)
         # Note: data are all non-negative!!
         if get_dist:
-            rel_dist = np.linalg.norm(rel_data, axis=2) if data_dim > 1 else rel_data.squeeze()
+            rel_dist = np.sqrt(np.einsum('ijk,ijk->ij', rel_data, rel_data)) if data_dim > 1 else rel_data.squeeze()
         else:
             rel_dist = None
 
@@ -983,9 +1509,9 @@ class LazyControlFlockingEnv(gym.Env):
         """
         if self.config.env.task_type=='vicsek':
             speed = self.config.control.speed
-            velocities = state["agent_states"][:, 2:4]  # (num_agents_max, 2)
-            average_velocity = np.mean(velocities, axis=0)  # (2, )
-            alignment = np.linalg.norm(average_velocity) / speed  # scalar in range [0, 1]
+            # The padded rows are zero, so the sum over all rows is the active-agent sum; average over the active ones
+            velocity_sum = state["agent_states"][:, 2:4].sum(axis=0)  # (2, )
+            alignment = np.hypot(velocity_sum[0], velocity_sum[1]) / (self.num_agents * speed)  # scalar in [0, 1]
             self.alignment_hist[self.time_step] = alignment
 
             rewards = np.repeat(alignment, self.num_agents_max)  # (num_agents_max, )
@@ -1019,17 +1545,20 @@ class LazyControlFlockingEnv(gym.Env):
         # # We assume that the neighbor_masks are up-to-date and include the paddings (0) and self-loops (1)
         neighbor_masks = state["neighbor_masks"]  # (num_agents_max, num_agents_max); self not included
         padding_mask = state["padding_mask"]
-        active_agents_indices = np.nonzero(padding_mask)[0]  # (num_agents, )
-        active_agents_indices_2d = np.ix_(active_agents_indices, active_agents_indices)
+        active_agents_indices, active_agents_indices_2d = self.get_active_agents_indices(padding_mask)
         # # Add self-loops only for the active agents
         # neighbor_masks_with_self_loops = neighbor_masks.copy()
         # neighbor_masks_with_self_loops[active_agents_indices_2d] = 1
 
         # (1) Get [x, y], [vx==cos(th), vy] in rel_state (active agents only)
         active_agents_rel_positions = rel_state["rel_agent_positions"][active_agents_indices_2d]  # (n, n, 2)
-        active_agents_rel_headings = rel_state["rel_agent_headings"][active_agents_indices_2d]
-        # active_agents_rel_headings = wrap_to_pi(active_agents_rel_headings)  # MUST be wrapped to [-pi, pi]?
-        active_agents_rel_headings = active_agents_rel_headings[:, :, np.newaxis]  # (num_agents, num_agents, 1)
+        # cos/sin(θ_j - θ_i) from the per-agent cos/sin via the angle-difference identities (no per-pair trig)
+        cos_th = rel_state["heading_cos"][active_agents_indices]  # (num_agents, )
+        sin_th = rel_state["heading_sin"][active_agents_indices]  # (num_agents, )
+        active_agents_rel_headings_cos = (cos_th[np.newaxis, :] * cos_th[:, np.newaxis]
+                                          + sin_th[np.newaxis, :] * sin_th[:, np.newaxis])[:, :, np.newaxis]
+        active_agents_rel_headings_sin = (sin_th[np.newaxis, :] * cos_th[:, np.newaxis]
+                                          - cos_th[np.newaxis, :] * sin_th[:, np.newaxis])[:, :, np.newaxis]
 
         # (2) Map periodic to continuous space if necessary: [x, y] -> [cos(x), sin(x), cos(y), sin(y)]
         l = self.config.control.initial_position_bound
@@ -1043,12 +1572,12 @@ class LazyControlFlockingEnv(gym.Env):
         # (3) Concat all
         active_agents_obs = np.concatenate(
             [active_agents_rel_positions,    # (num_agents, num_agents, 4 or 2)
-             np.cos(active_agents_rel_headings),  # (num_agents, num_agents, 1)
-             np.sin(active_agents_rel_headings),  # (num_agents, num_agents, 1)
+             active_agents_rel_headings_cos,  # (num_agents, num_agents, 1)
+             active_agents_rel_headings_sin,  # (num_agents, num_agents, 1)
              ],
             axis=2
         )  # (num_agents, num_agents, obs_dim)
-        agents_obs = np.zeros((self.num_agents_max, self.num_agents_max, self.config.env.obs_dim), dtype=np.float64)
+        agents_obs = np.zeros((self.num_agents_max, self.num_agents_max, self.config.env.obs_dim), dtype=np.float32)
         agents_obs[active_agents_indices_2d] = active_agents_obs  # (num_agents_max, num_agents_max, obs_dim)
 
         # Construct observation
@@ -1095,14 +1624,15 @@ class LazyControlFlockingEnv(gym.Env):
 
         # 1. Check if the control task is done
         if self.config.env.task_type=='vicsek':
+            # Track the alignment window every step, so the min/max below are O(1)
+            self._alignment_window.push(self.time_step, self.alignment_hist[self.time_step])
             # Check alignment
             if self.alignment_hist[self.time_step] > self.config.env.alignment_goal:
                 if not self.config.env.use_fixed_episode_length:
                     win_len = self.config.env.alignment_window_length - 1
                     if self.time_step >= win_len:
-                        last_n_alignments = self.alignment_hist[self.time_step - win_len:self.time_step + 1]
-                        max_alignment = np.max(last_n_alignments)
-                        min_alignment = np.min(last_n_alignments)
+                        max_alignment = self._alignment_window.max()
+                        min_alignment = self._alignment_window.min()
                         if max_alignment - min_alignment < self.config.env.alignment_rate_goal:
                             done = True
         elif self.config.env.task_type=='acs':
@@ -1110,6 +1640,8 @@ class LazyControlFlockingEnv(gym.Env):
             spatial_entropy, velocity_entropy = self._get_entropy(state)
             self.spatial_entropy_hist[self.time_step] = spatial_entropy
             self.velocity_entropy_hist[self.time_step] = velocity_entropy
+            self._spatial_entropy_window.push(self.time_step, spatial_entropy)
+            self._velocity_entropy_window.push(self.time_step, velocity_entropy)
 
             # Check if the spatial and velocity entropies are within the goals
             if (spatial_entropy < self.config.env.entropy_p_goal) and (velocity_entropy < self.config.env.entropy_v_goal):
@@ -1117,10 +1649,8 @@ class LazyControlFlockingEnv(gym.Env):
                     # Check if the entropies are stable over the last N steps (entropy rate checks)
                     effective_win_len = self.config.env.entropy_rate_window_length - 1
                     if self.time_step >= effective_win_len:
-                        last_n_spatial_entropies = self.spatial_entropy_hist[self.time_step - effective_win_len:self.time_step + 1]
-                        last_n_velocity_entropies = self.velocity_entropy_hist[self.time_step - effective_win_len:self.time_step + 1]
-                        spatial_entropy_rate = np.max(last_n_spatial_entropies) - np.min(last_n_spatial_entropies)
-                        velocity_entropy_rate = np.max(last_n_velocity_entropies)
+                        spatial_entropy_rate = self._spatial_entropy_window.max() - self._spatial_entropy_window.min()
+                        velocity_entropy_rate = self._velocity_entropy_window.max()
                         if (spatial_entropy_rate < self.config.env.entropy_p_rate_goal) and (velocity_entropy_rate < self.config.env.entropy_v_rate_goal):
                             done = True
         else:
@@ -1141,8 +1671,9 @@ class LazyControlFlockingEnv(gym.Env):
         if self.config.env.env_mode == "single_env":
             return done
         elif self.config.env.env_mode == "multi_env":
-            # padding agents: False
-            dones_in_array = np.ones(self.num_agents_max, dtype=np.bool_)
+            # padding agents: True (done); reused buffer, single_to_multi copies the entries out as scalars
+            dones_in_array = self._dones_buf
+            dones_in_array.fill(True)
             # done for swarm agents
             dones_in_array[padding_mask] = done
             dones = self.single_to_multi(dones_in_array)
@@ -1153,14 +1684,23 @@ class LazyControlFlockingEnv(gym.Env):
             raise ValueError(f"self.env_mode: 'single_env' / 'multi_env'; not {self.config.env.env_mode}; in check_episode_termination()")
 
     def _get_entropy(self, state):
-        padding_mask = state["padding_mask"]
-        masked_states = state["agent_states"][padding_mask]  # (num_agents, 4)  <- for optimized indexing
+        # The active-agent indices are memoized per padding_mask; with the tail padding of reset/custom_reset the
+        # active rows are a plain slice (a view, no boolean-mask copy)
+        active_agents_indices, _ = self.get_active_agents_indices(state["padding_mask"])
+        num_agents = active_agents_indices.size
+        if active_agents_indices[-1] == num_agents - 1:
+            masked_states = state["agent_states"][:num_agents]  # (num_agents, 5)
+        else:
+            masked_states = state["agent_states"][active_agents_indices]  # (num_agents, 5)
+        if NUMBA_AVAILABLE:
+            return _entropy_kernel(masked_states)  # both entropies in one pass
+
         agent_positions = masked_states[:, :2]    # (num_agents, 2)
         agent_velocities = masked_states[:, 2:4]  # (num_agents, 2)
 
-        # Get spatial and velocity entropy
-        spatial_entropy = np.sqrt(np.sum(np.var(agent_positions, axis=0)))    # scalar
-        velocity_entropy = np.sqrt(np.sum(np.var(agent_velocities, axis=0)))  # scalar
+        # Get spatial and velocity entropy; math.sqrt on the float sums (no ufunc dispatch on 0-d values)
+        spatial_entropy = math.sqrt(float(np.var(agent_positions, axis=0).sum()))    # scalar
+        velocity_entropy = math.sqrt(float(np.var(agent_velocities, axis=0).sum()))  # scalar
 
         return spatial_entropy, velocity_entropy
 
@@ -1173,29 +1713,27 @@ class LazyControlFlockingEnv(gym.Env):
         :return: custom_reward
         """
         if self.config.env.is_training and self.config.env.task_type=='acs':
-            # Get spatial entropy errors
-            std_pos = self.spatial_entropy_hist[self.time_step]  # scalar
-            std_pos_target = self.config.env.entropy_p_goal - 2.5
-            std_pos_error = (std_pos - std_pos_target) ** 2  # (100-40)**2 = 3600
-            pos_error_reward = - (1 / 3600) * np.maximum(std_pos_error, 0)
-
-            # Get velocity entropy errors
-            std_vel = self.velocity_entropy_hist[self.time_step]
-            std_vel_target = self.config.env.entropy_v_goal - 0.05
-            std_vel_error = (std_vel - std_vel_target) ** 2  # (15-0.05)**2 = 223.5052
-            vel_error_reward = - (1 / 220) * np.maximum(std_vel_error, 0.0)
-
-            # Get control cost
-            rho = self.config.control.rho
-            control_cost = rewards.sum() / self.num_agents
-            control_cost = control_cost + (rho * self.config.env.dt)
+            return self._compute_acs_reward(state, rel_state, control_inputs, rewards, done)
+
+        return self._compute_no_reward(state, rel_state, control_inputs, rewards, done)
 
-            # Get the custom reward
-            custom_reward = (self.config.env.acs_train_w_pos * pos_error_reward
-                             + self.config.env.acs_train_w_vel * vel_error_reward
-                             - self.config.env.acs_train_w_ctrl * control_cost)
-            return custom_reward
+    def _compute_acs_reward(self, state, rel_state, control_inputs, rewards, done):
+        """
+        Custom reward of the ACS training: entropy errors and control cost
+        :return: custom_reward (scalar)
+        """
+        # Spatial/velocity entropy errors; squared, so already >= 0; the scalars are set in __init__
+        pos_error = self.spatial_entropy_hist[self.time_step] - self._std_pos_target
+        vel_error = self.velocity_entropy_hist[self.time_step] - self._std_vel_target
+        # Control cost
+        control_cost = rewards.sum() / self.num_agents + self._rho_dt
 
+        # Get the custom reward
+        return -(self._w_pos * pos_error * pos_error + self._w_vel * vel_error * vel_error
+                 + self._w_ctrl * control_cost)
+
+    @staticmethod
+    def _compute_no_reward(state, rel_state, control_inputs, rewards, done):
         return NotImplemented
 
     def render(self, mode='human'):
@@ -1207,6 +1745,398 @@ class LazyControlFlockingEnv(gym.Env):
         pass
 
 
+class BatchedLazyControlFlockingEnv(LazyControlFlockingEnv):
+    """
+    Runs *batch_size* independent flocks (worlds) in lock-step within one env object.
+    Every state array carries a leading batch axis, e.g. agent_states: (B, num_agents_max, 5),
+    so a step is one set of numpy calls for all the worlds instead of B Python-level env steps.
+
+    env_context: the same as LazyControlFlockingEnv, plus "batch_size" (int, default 1).
+    Supports env_mode='single_env' with the fully-connected or comm_range networks;
+    the fixed (line/ring/star) topologies, the state/action histories and the acs training reward (is_training)
+    raise NotImplementedError, and the post_process_obs/compute_custom_reward hooks of the single env are not used here.
+    All worlds are reset together; a world that is done keeps stepping until the next reset().
+    """
+    def __init__(self, env_context: dict):
+        super().__init__(env_context)
+        self.batch_size = int(env_context.get("batch_size", 1))
+        assert self.batch_size > 0, "batch_size must be > 0"
+        if self.config.env.env_mode != "single_env":
+            raise NotImplementedError("BatchedLazyControlFlockingEnv supports env_mode='single_env' only")
+        if self.config.env.enable_custom_topology:
+            raise NotImplementedError("BatchedLazyControlFlockingEnv does not support custom topologies")
+        if self.config.env.is_training and self.config.env.task_type == "acs":
+            raise NotImplementedError("BatchedLazyControlFlockingEnv does not support is_training (the entropy-shaped "
+                                      "acs training reward); set is_training=False or use LazyControlFlockingEnv")
+        if self.config.env.get_state_hist or self.config.env.get_action_hist:
+            raise NotImplementedError("BatchedLazyControlFlockingEnv does not support get_state_hist/get_action_hist")
+
+        # Per-world spaces stay available; the batched ones get the leading batch axis
+        self.single_action_space = self.action_space
+        self.single_observation_space = self.observation_space
+        self.action_space = batch_space(self.single_action_space, self.batch_size)
+        self.observation_space = batch_space(self.single_observation_space, self.batch_size)
+
+        # Batched counterparts of the single-env episode data
+        self.num_agents = None  # (B, )
+        self.has_lost_comm = None  # (B, )
+        self.lost_comm_step = None  # (B, )
+        # Batched control-input buffer; the lazy product in step() is a new array, as in the single env
+        self._control_inputs_buf = np.empty((self.batch_size, self.num_agents_max), dtype=np.float32)
+
+    def reset(self):
+        # Init time steps
+        self.time_step = 0
+        batch_size, num_agents_max = self.batch_size, self.num_agents_max
+
+        # Get initial num_agents of each world
+        self.num_agents = self.np_random.choice(self.num_agents_pool_np, size=batch_size)  # (B, )
+        padding_mask = np.arange(num_agents_max)[np.newaxis, :] < self.num_agents[:, np.newaxis]  # (B, n_a_max)
+        padding_mask_2d = padding_mask[:, :, np.newaxis] & padding_mask[:, np.newaxis, :]  # (B, n_a_max, n_a_max)
+
+        # Generate initial agent states: [x, y, vx, vy, theta]; padded agents stay at zero
+        agent_states = np.zeros((batch_size, num_agents_max, 5), dtype=np.float32)  # (B, num_agents_max, 5)
+        l2 = self.config.control.initial_position_bound / 2
+        agent_states[:, :, :2] = self.np_random.uniform(-l2, l2, size=(batch_size, num_agents_max, 2))
+        agent_states[:, :, 4] = self.np_random.uniform(-np.pi, np.pi, size=(batch_size, num_agents_max))
+        agent_states *= padding_mask[:, :, np.newaxis]
+        np.cos(agent_states[:, :, 4], out=agent_states[:, :, 2])
+        np.sin(agent_states[:, :, 4], out=agent_states[:, :, 3])
+        agent_states[:, :, 2:4] *= self.config.control.speed * padding_mask[:, :, np.newaxis]
+
+        self.state = {"agent_states": agent_states, "padding_mask": padding_mask, "padding_mask_2d": padding_mask_2d}
+        self.rel_state = self.get_relative_state(state=self.state)
+        self.state["neighbor_masks"], _ = self.get_neighbor_masks(self.state, self.rel_state)
+        self.has_lost_comm = np.zeros(batch_size, dtype=np.bool_)
+        self.lost_comm_step = np.full(batch_size, -1)
+
+        # Historical data
+        self.alignment_hist = np.zeros((batch_size, self.config.env.max_time_steps))
+        self.spatial_entropy_hist = np.zeros((batch_size, self.config.env.max_time_steps))
+        self.velocity_entropy_hist = np.zeros((batch_size, self.config.env.max_time_steps))
+
+        return self.get_obs(state=self.state, rel_state=self.rel_state, control_inputs=None)
+
+    def step(self, action):
+        """
+        Step all the worlds
+        :param action: ndarray of shape (B, num_agents_max); laziness in [0, 1]
+        :return: obs (batched dict), reward (B, ), done (B, ), info (dict of batched arrays)
+        """
+        state = self.state
+        rel_state = self.rel_state
+        time_step = self.time_step
+
+        assert action.shape == (self.batch_size, self.num_agents_max), \
+            "action must have shape (batch_size, num_agents_max); got {}".format(action.shape)
+        if action.min() < 0.0 or action.max() > 1.0:
+            print(f"Warning: action must be in [0, 1]; But got max={action.max()}, min={action.min()}")
+            action = np.clip(action, 0.0, 1.0)
+
+        # s` = T(s, a)
+        control_inputs = self._get_control(state, rel_state, state["neighbor_masks"])  # (B, num_agents_max)
+        control_inputs = (1 - action) * control_inputs
+        next_state = {"agent_states": self.update_agent_states(state, control_inputs),
+                      "padding_mask": state["padding_mask"],
+                      "padding_mask_2d": state["padding_mask_2d"],
+                      }
+        next_rel_state = self.get_relative_state(state=next_state)
+        next_state["neighbor_masks"], comm_loss_agents = self.get_neighbor_masks(next_state, next_rel_state)
+        # r = R(s, a, s`)
+        rewards = self._compute_rewards(
+            state=state, action=action, next_state=next_state, control_inputs=control_inputs)  # (B, n_a_max)
+        # o = H(s`)
+        obs = self.get_obs(state=next_state, rel_state=next_rel_state, control_inputs=control_inputs)
+        done = self.check_episode_termination(state=next_state, rel_state=next_rel_state,
+                                              comm_loss_agents=comm_loss_agents)  # (B, )
+        reward = rewards.sum(axis=1) / self.num_agents  # (B, )
+
+        is_acs = self.config.env.task_type == "acs"
+        info = {
+            "spatial_entropy": self.spatial_entropy_hist[:, time_step] if is_acs else None,
+            "velocity_entropy": self.velocity_entropy_hist[:, time_step] if is_acs else None,
+            "alignment": None if is_acs else self.alignment_hist[:, time_step],
+            "original_reward": reward,
+            "comm_loss_agents": comm_loss_agents,
+        }
+
+        self.state = next_state
+        self.rel_state = next_rel_state
+        self.time_step = time_step + 1
+        return obs, reward, done, info
+
+    def get_relative_state(self, state):
+        """
+        Batched get_relative_state; rel_agent_states[b, i, j] = agent_states[b, j] - agent_states[b, i]
+        """
+        agent_states = state["agent_states"]  # (B, num_agents_max, 5)
+        rel_agent_states = agent_states[:, np.newaxis, :, :] - agent_states[:, :, np.newaxis, :]  # (B, n, n, 5)
+        rel_agent_states *= state["padding_mask_2d"][:, :, :, np.newaxis]
+        rel_agent_positions = rel_agent_states[..., :2]   # (B, num_agents_max, num_agents_max, 2)
+        if self.config.env.periodic_boundary:
+            l = self.config.control.initial_position_bound
+            rel_agent_positions -= l * np.round(rel_agent_positions / l)  # minimum image
+        rel_agent_dists = np.sqrt(np.einsum('bijk,bijk->bij', rel_agent_positions, rel_agent_positions))
+
+        return {"rel_agent_positions": rel_agent_positions,      # (B, num_agents_max, num_agents_max, 2)
+                "rel_agent_velocities": rel_agent_states[..., 2:4],  # (B, num_agents_max, num_agents_max, 2)
+                "rel_agent_headings": rel_agent_states[..., 4],  # (B, num_agents_max, num_agents_max)
+                "rel_agent_dists": rel_agent_dists,              # (B, num_agents_max, num_agents_max)
+                }
+
+    def get_neighbor_masks(self, state, rel_state):
+        """
+        Batched network update from the relative distances of the (next) state
+        :return: neighbor_masks (B, num_agents_max, num_agents_max), comm_loss_agents (B, num_agents_max) or None
+        """
+        if self.config.env.comm_range is None:
+            # Fully connected, as in the single env
+            neighbor_masks = np.ones((self.batch_size, self.num_agents_max, self.num_agents_max), dtype=np.bool_)
+            return neighbor_masks, None
+        # Neighbors within the comm_range, incl. the self-loops of the active agents
+        neighbor_masks = (rel_state["rel_agent_dists"] <= self.config.env.comm_range) & state["padding_mask_2d"]
+        comm_loss_agents = state["padding_mask"] & (neighbor_masks.sum(axis=2) == 1)  # is alone in the network?
+        return neighbor_masks, comm_loss_agents
+
+    def get_vicsek_control(self, state, rel_state, new_network):
+        """
+        Batched Vicsek control inputs
+        :return: u (B, num_agents_max); a per-env buffer, overwritten by the next call
+        """
+        net = new_network & state["padding_mask_2d"]  # (B, num_agents_max, num_agents_max)
+        n = net.sum(axis=2, dtype=np.float32) + np.finfo(float).eps  # (B, num_agents_max)
+        average_heading = (rel_state["rel_agent_headings"] * net).sum(axis=2) / n  # (B, num_agents_max)
+        u_max = self.config.control.max_turn_rate
+        average_heading /= self.config.env.dt
+        return np.clip(average_heading, -u_max, u_max, out=self._control_inputs_buf)  # (B, num_agents_max)
+
+    def get_acs_control(self, state, rel_state, new_network):
+        """
+        Batched ACS control inputs; the same terms as LazyControlFlockingEnv.get_acs_control
+        :return: u (B, num_agents_max); a per-env buffer, overwritten by the next call
+        """
+        p = rel_state["rel_agent_positions"]   # (B, num_agents_max, num_agents_max, 2)
+        v = rel_state["rel_agent_velocities"]  # (B, num_agents_max, num_agents_max, 2)
+        th = rel_state["rel_agent_headings"]   # (B, num_agents_max, num_agents_max)
+        th_i = state["agent_states"][:, :, 4]  # (B, num_agents_max)
+        net = new_network & state["padding_mask_2d"]  # (B, num_agents_max, num_agents_max)
+
+        beta = self.config.control.beta
+        lam = self.config.control.lam
+        k1 = self.config.control.k1
+        k2 = self.config.control.k2
+        spd = self.config.control.speed
+        u_max = self.config.control.max_turn_rate
+        r0 = self.config.control.r0
+        sig = self.config.control.sig
+
+        # Non-neighbor pairs get r=1 so the 1/r terms stay finite before the net mask; eps on the self-loops
+        r = np.where(net, rel_state["rel_agent_dists"], 1.0)  # (B, num_agents_max, num_agents_max)
+        diag = np.arange(self.num_agents_max)
+        r[:, diag, diag] += np.finfo(float).eps
+        N = net.sum(axis=2, dtype=np.float32) + np.finfo(float).eps  # (B, num_agents_max)
+
+        # 1. Alignment
+        psi = _compute_psi(r**2, beta, self._psi_mode)
+        u_cs = (lam / N) * (psi * np.sin(th) * net).sum(axis=2)  # (B, num_agents_max)
+
+        # 2. Cohesion and separation
+        v_dot_p = v[..., 0] * p[..., 0] + v[..., 1] * p[..., 1]
+        dir_dot_p = -np.sin(th_i)[:, :, np.newaxis] * p[..., 0] + np.cos(th_i)[:, :, np.newaxis] * p[..., 1]
+        u_coh = sig / (N * spd) * np.sum((k1 / (2 * r**2) * v_dot_p + k2 / (2 * r) * (r - r0)) * dir_dot_p * net, axis=2)
+
+        # 3. Saturation; the padded agents are already 0
+        u_cs += u_coh
+        return np.clip(u_cs, -u_max, u_max, out=self._control_inputs_buf)  # (B, num_agents_max)
+
+    def update_agent_states(self, state, control_inputs, out=None):
+        """
+        Batched update_agent_states
+        :return: next_agent_states (B, num_agents_max, 5)
+        """
+        agent_states = state["agent_states"]
+        dt = self.config.env.dt
+        next_agent_states = np.empty_like(agent_states) if out is None else out
+
+        next_agent_positions = agent_states[:, :, :2] + agent_states[:, :, 2:4] * dt  # (B, num_agents_max, 2)
+        if self.config.env.periodic_boundary:
+            w = h = self.config.control.initial_position_bound
+            next_agent_positions = wrap_to_rectangle(next_agent_positions, w, h)
+        next_agent_states[:, :, :2] = next_agent_positions
+        next_agent_headings = agent_states[:, :, 4] + control_inputs * dt  # (B, num_agents_max)
+        next_agent_states[:, :, 4] = next_agent_headings
+        np.cos(next_agent_headings, out=next_agent_states[:, :, 2])
+        np.sin(next_agent_headings, out=next_agent_states[:, :, 3])
+        next_agent_states[:, :, 2:4] *= self.config.control.speed
+        next_agent_states[:, :, 2:4] *= state["padding_mask"][:, :, np.newaxis]
+
+        return next_agent_states
+
+    def _compute_rewards(self, state, action, next_state, control_inputs: np.ndarray):
+        """
+        Batched _compute_rewards
+        :return: rewards: (B, num_agents_max)
+        """
+        padding_mask = state["padding_mask"]
+        if self.config.env.task_type == 'vicsek':
+            velocity_sum = state["agent_states"][:, :, 2:4].sum(axis=1)  # (B, 2); the padded rows are zero
+            num_agents = padding_mask.sum(axis=1)  # (B, )
+            alignment = np.hypot(velocity_sum[:, 0], velocity_sum[:, 1]) / (num_agents * self.config.control.speed)
+            self.alignment_hist[:, self.time_step] = alignment
+            return alignment[:, np.newaxis] * padding_mask  # (B, num_agents_max)
+        elif self.config.env.task_type == 'acs':
+            heading_rate_costs = (self.config.env.dt * self.config.control.speed) * np.abs(control_inputs)
+            cruise_costs = self.config.env.dt
+            return -(heading_rate_costs + self.config.control.rho * cruise_costs) * padding_mask  # (B, n_a_max)
+        else:
+            raise NotImplementedError("task_type not implemented yet")
+
+    def get_obs(self, state, rel_state, control_inputs):
+        """
+        Batched get_obs; each entry gets the leading batch axis
+        :return: obs
+        """
+        padding_mask_2d = state["padding_mask_2d"]
+        rel_agent_positions = rel_state["rel_agent_positions"]  # (B, num_agents_max, num_agents_max, 2)
+        rel_agent_headings = rel_state["rel_agent_headings"]    # (B, num_agents_max, num_agents_max)
+
+        agents_obs = np.empty(  # (B, num_agents_max, num_agents_max, obs_dim)
+            (self.batch_size, self.num_agents_max, self.num_agents_max, self.config.env.obs_dim), dtype=np.float32)
+        l = self.config.control.initial_position_bound
+        if self.config.env.periodic_boundary:
+            agents_obs[..., :4] = map_periodic_to_continuous_space(rel_agent_positions, l, l)
+        else:
+            np.divide(rel_agent_positions, l / 2.0, out=agents_obs[..., :2])
+        np.cos(rel_agent_headings, out=agents_obs[..., -2])
+        np.sin(rel_agent_headings, out=agents_obs[..., -1])
+        agents_obs *= padding_mask_2d[:, :, :, np.newaxis]  # padded pairs are all zeros
+
+        return {"local_agent_infos": agents_obs,                    # (B, num_agents_max, num_agents_max, obs_dim)
+                "neighbor_masks": state["neighbor_masks"],          # (B, num_agents_max, num_agents_max)
+                "padding_mask": state["padding_mask"],              # (B, num_agents_max)
+                "is_from_my_env": np.ones(self.batch_size, dtype=np.bool_),  # (B, )
+                }
+
+    def check_episode_termination(self, state, rel_state, comm_loss_agents):
+        """
+        Batched check_episode_termination
+        :return: done (B, )
+        """
+        t = self.time_step
+        env_cfg = self.config.env
+        if env_cfg.task_type == 'vicsek':
+            done = self.alignment_hist[:, t] > env_cfg.alignment_goal
+            win_len = env_cfg.alignment_window_length - 1
+            if env_cfg.use_fixed_episode_length or t < win_len:
+                done[:] = False
+            else:
+                last_n_alignments = self.alignment_hist[:, t - win_len:t + 1]
+                done &= (last_n_alignments.max(axis=1) - last_n_alignments.min(axis=1)) < env_cfg.alignment_rate_goal
+        elif env_cfg.task_type == 'acs':
+            spatial_entropy, velocity_entropy = self._get_entropy(state)  # (B, ), (B, )
+            self.spatial_entropy_hist[:, t] = spatial_entropy
+            self.velocity_entropy_hist[:, t] = velocity_entropy
+            done = (spatial_entropy < env_cfg.entropy_p_goal) & (velocity_entropy < env_cfg.entropy_v_goal)
+            win_len = env_cfg.entropy_rate_window_length - 1
+            if env_cfg.use_fixed_episode_length or t < win_len:
+                done[:] = False
+            else:
+                last_n_spatial_entropies = self.spatial_entropy_hist[:, t - win_len:t + 1]
+                spatial_entropy_rate = last_n_spatial_entropies.max(axis=1) - last_n_spatial_entropies.min(axis=1)
+                velocity_entropy_rate = self.velocity_entropy_hist[:, t - win_len:t + 1].max(axis=1)
+                done &= (spatial_entropy_rate < env_cfg.entropy_p_rate_goal) & \
+                        (velocity_entropy_rate < env_cfg.entropy_v_rate_goal)
+        else:
+            raise NotImplementedError(f"task_type({env_cfg.task_type}) not implemented/supported yet")
+
+        # Max time step
+        if t >= env_cfg.max_time_steps - 1:
+            done[:] = True
+
+        # Communication loss
+        if env_cfg.comm_range is not None:
+            lost = comm_loss_agents.any(axis=1) & ~done  # (B, )
+            self.lost_comm_step[lost] = t  # the latest lossy step, as in the single env
+            self.has_lost_comm |= lost
+            if not env_cfg.ignore_comm_lost_agents:
+                done |= lost
+
+        return done
+
+    def _get_entropy(self, state):
+        padding_mask = state["padding_mask"][:, :, np.newaxis]  # (B, num_agents_max, 1)
+        num_agents = self.num_agents[:, np.newaxis]  # (B, 1)
+        agent_states = state["agent_states"]
+        entropies = []
+        for data in (agent_states[:, :, :2], agent_states[:, :, 2:4]):  # positions, velocities
+            mean = (data * padding_mask).sum(axis=1) / num_agents  # (B, 2)
+            var = (((data - mean[:, np.newaxis, :]) * padding_mask) ** 2).sum(axis=1) / num_agents  # (B, 2)
+            entropies.append(np.sqrt(var.sum(axis=1)))  # (B, )
+
+        return entropies[0], entropies[1]  # spatial, velocity entropy: (B, ), (B, )
+
+
+@functools.lru_cache(maxsize=None)
+def _agent_colors(num_agents: int):
+    """
+    Jet colors of the agents, (num_agents, 4) RGBA; cached per num_agents across visualize_results calls
+    (read-only, as the array is shared)
+    """
+    colors = plt.cm.jet(np.linspace(0, 1, num_agents))
+    colors.setflags(write=False)
+    return colors
+
+
+@njit(cache=True, parallel=True)
+def _unwrap_periodic_kernel(positions, bound):
+    """
+    Numba version of _unwrap_periodic_trajectories: agents in parallel, a sequential scan over the steps per agent
+    with a running (x, y) offset
+    :param positions: (num_steps, num_agents, 2) wrapped positions
+    :param bound: side length of the square
+    :return: (num_steps, num_agents, 2) continuous positions
+    """
+    num_steps, num_agents = positions.shape[0], positions.shape[1]
+    half = bound / 2
+    out = np.empty_like(positions)
+    for a in prange(num_agents):
+        for k in range(2):
+            offset = 0.0
+            out[0, a, k] = positions[0, a, k]
+            for t in range(1, num_steps):
+                jump = positions[t, a, k] - positions[t - 1, a, k]
+                if jump < -half:
+                    offset += bound
+                elif jump > half:
+                    offset -= bound
+                out[t, a, k] = positions[t, a, k] + offset
+    return out
+
+
+def _unwrap_periodic_trajectories(positions, bound):
+    """
+    Continuous trajectories from positions wrapped into a periodic square: a step larger than half the bound is a
+    wrap; every later position is shifted by the running count of wraps (the shifts leave the later step sizes unchanged)
+    :param positions: (num_steps, num_agents, 2) wrapped positions
+    :param bound: side length of the square (config.control.initial_position_bound)
+    :return: (num_steps, num_agents, 2) continuous positions (a new array)
+    """
+    if NUMBA_AVAILABLE:
+        return _unwrap_periodic_kernel(positions, bound)
+    continuous_positions = np.copy(positions)
+    jumps = np.diff(positions, axis=0)  # (num_steps-1, num_agents, 2)
+    wraps = (jumps < -bound / 2).astype(np.int32) - (jumps > bound / 2)  # (num_steps-1, num_agents, 2); +1, -1 or 0
+    continuous_positions[1:] += np.cumsum(wraps, axis=0) * bound
+    return continuous_positions
+
+
+def _flat_trajectories(positions, bound):
+    """
+    Trajectories in a non-periodic space are already continuous; same signature as _unwrap_periodic_trajectories
+    """
+    return positions
+
+
 def visualize_results(agent_states, spatial_entropy_hist, velocity_entropy_hist, episode_length, config):
     """
     Visualize the results of the simulation
@@ -1227,78 +2157,44 @@ def visualize_results(agent_states, spatial_entropy_hist, velocity_entropy_hist,
     num_agents = int(np.sum(padding_mask))
 
     # Set colormap for agents
-    colors = plt.cm.jet(np.linspace(0, 1, num_agents))
-
-    # Store min/max positions to set appropriate plot boundaries
-    min_x, max_x = float('inf'), float('-inf')
-    min_y, max_y = float('inf'), float('-inf')
-
-    # Plot trajectories for each agent
-    for i in range(num_agents):
-        # Extract positions for this agent
-        positions = agent_states[:, i, :2]  # (num_steps, 2)
-
-        # Update min/max positions
-        min_x = min(min_x, np.min(positions[:, 0]))
-        max_x = max(max_x, np.max(positions[:, 0]))
-        min_y = min(min_y, np.min(positions[:, 1]))
-        max_y = max(max_y, np.max(positions[:, 1]))
-
-        # For periodic boundaries, create continuous trajectories
-        if config.env.periodic_boundary:
-            boundary = config.control.initial_position_bound / 2
-            continuous_positions = np.copy(positions)
-
-            # Detect and fix jumps in x coordinate
-            for j in range(1, len(continuous_positions)):
-                if abs(continuous_positions[j, 0] - continuous_positions[j - 1, 0]) > boundary:
-                    # Jump detected, adjust positions accordingly
-                    if continuous_positions[j, 0] - continuous_positions[j - 1, 0] > 0:
-                        continuous_positions[j:, 0] -= config.control.initial_position_bound
-                    else:
-                        continuous_positions[j:, 0] += config.control.initial_position_bound
-
-            # Detect and fix jumps in y coordinate
-            for j in range(1, len(continuous_positions)):
-                if abs(continuous_positions[j, 1] - continuous_positions[j - 1, 1]) > boundary:
-                    # Jump detected, adjust positions accordingly
-                    if continuous_positions[j, 1] - continuous_positions[j - 1, 1] > 0:
-                        continuous_positions[j:, 1] -= config.control.initial_position_bound
-                    else:
-                        continuous_positions[j:, 1] += config.control.initial_position_bound
-
-            # Use the continuous positions for plotting
-            ax_traj.plot(continuous_positions[:, 0], continuous_positions[:, 1], '-',
-                         color=colors[i], alpha=0.7, label=f'Agent {i + 1}')
-
-            # Mark the starting position
-            ax_traj.plot(continuous_positions[0, 0], continuous_positions[0, 1], 'o',
-                         color=colors[i], markersize=6)
-
-            # Plot arrow for final direction (use original position for final position)
-            final_pos = continuous_positions[-1]
-        else:
-            # For non-periodic boundaries, plot trajectories directly
-            ax_traj.plot(positions[:, 0], positions[:, 1], '-',
-                         color=colors[i], alpha=0.7, label=f'Agent {i + 1}')
-
-            # Mark the starting position
-            ax_traj.plot(positions[0, 0], positions[0, 1], 'o',
-                         color=colors[i], markersize=6)
-
-            # Plot arrow for final direction
-            final_pos = positions[-1]
-
-        # Plot arrow for final direction
-        final_vel = agent_states[-1, i, 2:4]
-        if np.linalg.norm(final_vel) > 0:
-            final_vel_norm = final_vel / np.linalg.norm(final_vel)
-            arrow_length = 10  # Adjust as needed
-            ax_traj.arrow(
-                final_pos[0], final_pos[1],
-                arrow_length * final_vel_norm[0], arrow_length * final_vel_norm[1],
-                head_width=3, head_length=5, fc=colors[i], ec=colors[i]
-            )
+    colors = _agent_colors(num_agents)  # (num_agents, 4); passed whole to the collection, scatter and quiver
+
+    # Positions of the active agents over the episode
+    positions = agent_states[:, :num_agents, :2]  # (num_steps, num_agents, 2)
+
+    # Store min/max positions to set appropriate plot boundaries; one reduction per bound over all agents and steps
+    points = positions.reshape(-1, 2)  # (num_steps * num_agents, 2)
+    min_x, min_y = points.min(axis=0)
+    max_x, max_y = points.max(axis=0)
+
+    # For periodic boundaries, create continuous trajectories; for non-periodic ones, plot trajectories directly
+    trajectory_fn = _unwrap_periodic_trajectories if config.env.periodic_boundary else _flat_trajectories
+    continuous_positions = trajectory_fn(positions, config.control.initial_position_bound)
+
+    # Plot trajectories of all agents as a single artist; long episodes are subsampled to ~1024 points per agent
+    # (the last point is kept so the lines end at the arrows) and rasterized, while the axes and text stay vector
+    stride = max(1, continuous_positions.shape[0] // 1024)
+    plot_steps = np.r_[0:continuous_positions.shape[0]:stride, continuous_positions.shape[0] - 1]
+    trajectories = LineCollection(continuous_positions[plot_steps].transpose(1, 0, 2), colors=colors, alpha=0.7)
+    trajectories.set_rasterized(True)
+    ax_traj.add_collection(trajectories)
+    # The collection has no per-agent labels; legend proxies are not drawn on the axes
+    agent_handles = [Line2D([], [], color=colors[i], alpha=0.7, label=f'Agent {i + 1}') for i in range(num_agents)]
+
+    # Mark the starting positions
+    ax_traj.scatter(continuous_positions[0, :, 0], continuous_positions[0, :, 1], color=colors, s=36, zorder=3)
+
+    # Plot arrows for final directions
+    final_pos = continuous_positions[-1]  # (num_agents, 2)
+    final_vel = agent_states[-1, :num_agents, 2:4]  # (num_agents, 2)
+    final_speed = np.linalg.norm(final_vel, axis=1)  # (num_agents, )
+    moving = final_speed > 0
+    arrow_length = 10  # Adjust as needed
+    final_vel_norm = arrow_length * final_vel[moving] / final_speed[moving, np.newaxis]
+    # One quiver (a single PolyCollection) for all agents, rasterized like the trajectories
+    arrows = ax_traj.quiver(final_pos[moving, 0], final_pos[moving, 1], final_vel_norm[:, 0], final_vel_norm[:, 1],
+                            color=colors[moving], angles='xy', scale_units='xy', scale=1, width=0.004, zorder=3)
+    arrows.set_rasterized(True)
 
     # Set plot limits with some margin
     boundary = config.control.initial_position_bound / 2
@@ -1323,7 +2219,7 @@ def visualize_results(agent_states, spatial_entropy_hist, velocity_entropy_hist,
     ax_traj.set_xlabel('X Position')
     ax_traj.set_ylabel('Y Position')
     ax_traj.set_title('Agent Trajectories and Final Directions')
-    ax_traj.legend(loc='upper right', bbox_to_anchor=(1.1, 1))
+    ax_traj.legend(handles=agent_handles, loc='upper right', bbox_to_anchor=(1.1, 1))
     ax_traj.grid(True, linestyle='--', alpha=0.7)
 
     # 2. Plot entropy changes
@@ -1,6 +1,8 @@
 import copy
 import torch.nn as nn
 
+from models.modules.multi_head_attention_layer import make_attention_bias
+
 
 class Decoder(nn.Module):
 
@@ -13,8 +15,12 @@ class Decoder(nn.Module):
 
     def forward(self, tgt, encoder_out, tgt_mask, src_tgt_mask):
         out = tgt
+        # converted once, shared by all the layers
+        tgt_attn_bias = make_attention_bias(tgt_mask, tgt.dtype)
+        src_tgt_attn_bias = make_attention_bias(src_tgt_mask, tgt.dtype)
         for layer in self.layers:
-            out = layer(out, encoder_out, tgt_mask, src_tgt_mask)
+            out = layer(out, encoder_out, tgt_mask, src_tgt_mask,
+                        tgt_attn_bias=tgt_attn_bias, src_tgt_attn_bias=src_tgt_attn_bias)
         out = self.norm(out)
         return out  # shape: (batch_size, tgt_seq_len, d_embed)
 
@@ -16,10 +16,12 @@ class DecoderBlock(nn.Module):
         self.position_ff = position_ff
         self.residual3 = ResidualConnectionLayer(copy.deepcopy(norm), dr_rate)
 
-    def forward(self, tgt, encoder_out, tgt_mask, src_tgt_mask):
+    def forward(self, tgt, encoder_out, tgt_mask, src_tgt_mask, tgt_attn_bias=None, src_tgt_attn_bias=None):
         out = tgt
-        out = self.residual1(out, lambda out: self.self_attention(query=out, key=out, value=out, mask=tgt_mask))
-        out = self.residual2(out, lambda out: self.cross_attention(query=out, key=encoder_out, value=encoder_out, mask=src_tgt_mask))
+        out = self.residual1(out, lambda out: self.self_attention(query=out, key=out, value=out, mask=tgt_mask,
+                                                                  attn_bias=tgt_attn_bias))
+        out = self.residual2(out, lambda out: self.cross_attention(query=out, key=encoder_out, value=encoder_out,
+                                                                   mask=src_tgt_mask, attn_bias=src_tgt_attn_bias))
         out = self.residual3(out, self.position_ff)
         return out
 
@@ -48,7 +50,7 @@ class CustomDecoderBlock(nn.Module):
         self.cross_attention = cross_attention
         self.position_ff = position_ff
 
-    def forward(self, tgt, encoder_out, tgt_mask, src_tgt_mask):
+    def forward(self, tgt, encoder_out, tgt_mask, src_tgt_mask, tgt_attn_bias=None, src_tgt_attn_bias=None):
         # tgt: (batch_size, tgt_seq_len, d_embed_context)
         # encoder_out: (batch_size, src_seq_len, d_embed_input)
         # tgt_mask: (batch_size, 1, tgt_seq_len, tgt_seq_len)
@@ -57,7 +59,7 @@ class CustomDecoderBlock(nn.Module):
         # MHA layer with query as the output of the first MHA layer
         # Shape: (batch_size, tgt_seq_len, d_model)
         tgt = self.residual2(tgt, lambda tgt: self.cross_attention(query=tgt, key=encoder_out, value=encoder_out,
-                                                                   mask=src_tgt_mask))
+                                                                   mask=src_tgt_mask, attn_bias=src_tgt_attn_bias))
         # Position-wise feed-forward network, applied only if include_ffn is True
         # Shape: (batch_size, tgt_seq_len, d_model)
         if self.position_ff is not None:
@@ -1,6 +1,8 @@
 import copy
 import torch.nn as nn
 
+from models.modules.multi_head_attention_layer import make_attention_bias
+
 
 class Encoder(nn.Module):
 
@@ -14,7 +16,8 @@ class Encoder(nn.Module):
         # src: shape: (batch_size, src_seq_len, d_embed==d_embed_input)
         # src_mask: shape: (batch_size, 1, src_seq_len, src_seq_len)
         out = src
+        src_attn_bias = make_attention_bias(src_mask, src.dtype)  # converted once, shared by all the layers
         for layer in self.layers:
-            out = layer(out, src_mask)
+            out = layer(out, src_mask, src_attn_bias=src_attn_bias)
         out = self.norm(out)
         return out  # shape: (batch_size, src_seq_len, d_embed)
@@ -13,11 +13,13 @@ class EncoderBlock(nn.Module):
         self.position_ff = position_ff
         self.residual2 = ResidualConnectionLayer(copy.deepcopy(norm), dr_rate)
 
-    def forward(self, src, src_mask):
+    def forward(self, src, src_mask, src_attn_bias=None):
         # src: shape: (batch_size, src_seq_len, d_embed==d_embed_input)
         # src_mask: shape: (batch_size, 1, src_seq_len, src_seq_len)
+        # src_attn_bias: optional make_attention_bias(src_mask) shared by the Encoder layers
         out = src
-        out = self.residual1(out, lambda out: self.self_attention(query=out, key=out, value=out, mask=src_mask))
+        out = self.residual1(out, lambda out: self.self_attention(query=out, key=out, value=out, mask=src_mask,
+                                                                  attn_bias=src_attn_bias))
         out = self.residual2(out, self.position_ff)
         # out: shape: (batch_size, src_seq_len, d_embed)
         return out
@@ -1,61 +1,112 @@
-import copy
-import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 
+def _copy_linear(fc, num_copies=1):
+    """
+    Copies an nn.Linear without deepcopy: the new layer is built on the meta device (no init, no RNG draw),
+    materialized on fc's device and filled with fc's parameters, stacked num_copies times along the output dim
+    :param fc: nn.Linear (in_features, out_features)
+    :return: nn.Linear (in_features, num_copies * out_features)
+    """
+    assert isinstance(fc, nn.Linear), "fc must be an nn.Linear"
+    out = nn.Linear(fc.in_features, num_copies * fc.out_features, bias=fc.bias is not None,
+                    device="meta", dtype=fc.weight.dtype).to_empty(device=fc.weight.device)
+    with torch.no_grad():
+        out.weight.copy_(fc.weight.repeat(num_copies, 1))
+        if fc.bias is not None:
+            out.bias.copy_(fc.bias.repeat(num_copies))
+    return out
+
+
+def make_attention_bias(mask, dtype=torch.float32):
+    """
+    Converts an attention mask (bool, int or float 0/1) into the additive form calculate_attention uses: 0 where
+    attended, -1e9 where masked. Build it once per forward pass and hand it to every layer that shares the mask
+    (e.g. the encoder layers) through their attn_bias argument
+    :param mask: (n_batch, 1, seq_len_query, seq_len_key); mask value 0: no attention
+    :param dtype: floating dtype of the attention inputs
+    :return: attention bias of the same shape, or None if mask is None
+    """
+    if mask is None:
+        return None
+    return torch.zeros(mask.shape, dtype=dtype, device=mask.device).masked_fill_(mask == 0, -1e9)
+
+
 class MultiHeadAttentionLayer(nn.Module):
     # Note: Hey! use right notations for d_k, d_v, d_model following the original transformer paper.
 
-    def __init__(self, d_model, h, q_fc, kv_fc, out_fc, dr_rate=0):
+    def __init__(self, d_model, h, q_fc, kv_fc, out_fc, dr_rate=0, share_kv=False):
         super(MultiHeadAttentionLayer, self).__init__()
         self.d_model = d_model
         self.h = h
+        self.share_kv = share_kv  # if True, K and V come from one shared W^K == W^V (less capacity, half the cost)
 
         # W^Q, W^K, W^V transform the input query, key, value to d_model dimension
-        self.q_fc = copy.deepcopy(q_fc)   # (d_embed_query, d_model)
-        self.k_fc = copy.deepcopy(kv_fc)  # (d_embed_key,   d_model)
-        self.v_fc = copy.deepcopy(kv_fc)  # (d_embed_value, d_model)
+        self.q_fc = _copy_linear(q_fc)   # (d_embed_query, d_model)
+        # W^K and W^V packed row-wise into one linear layer [W^K; W^V], so a shared key/value input is projected by
+        # a single GEMM; both halves start as copies of kv_fc, as two deep copies would
+        # With share_kv, a single copy serves as both W^K and W^V
+        assert kv_fc.out_features == d_model, "key and value must be transformed to d_model dimension"
+        self.kv_fc = _copy_linear(kv_fc, num_copies=1 if share_kv else 2)  # (d_embed_key, 2*d_model or d_model)
 
         # W^O transforms the attention vectors to d_embed_MHA_out dimension (desired output dim, mostly idempotent)
         self.out_fc = out_fc                  # (d_model, d_embed_MHA_out)
         self.dropout = nn.Dropout(p=dr_rate)  # if dr_rate == 0, identity mapping (no load on GPU/CPU)
 
-    def calculate_attention(self, query, key, value, mask):
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved before the packing have separate k_fc/v_fc entries; stack them into kv_fc
+        for name in ("weight", "bias"):
+            k_key, v_key = f"{prefix}k_fc.{name}", f"{prefix}v_fc.{name}"
+            if k_key in state_dict and v_key in state_dict:
+                state_dict[f"{prefix}kv_fc.{name}"] = torch.cat([state_dict.pop(k_key), state_dict.pop(v_key)], dim=0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def calculate_attention(self, query, key, value, mask, attn_bias=None):
         # query:      (n_batch, h, seq_len_query, d_k)
         # key, value: (n_batch, h, seq_len_key,   d_k)
-        # mask: (n_batch, 1, seq_len_query, seq_len_key)
-        d_k = key.shape[-1]
-        attention_score = torch.matmul(query, key.transpose(-2, -1))  # Q x K^T
-        attention_score = attention_score / math.sqrt(d_k)   # (n_batch, h, seq_len_query, seq_len_key)
-        if mask is not None:
-            attention_score = attention_score.masked_fill(mask == 0, -1e9)
-        attention_prob = F.softmax(attention_score, dim=-1)  # (n_batch, h, seq_len_query, seq_len_key)
-        attention_prob = self.dropout(attention_prob)
-        out = torch.matmul(attention_prob, value)
+        # mask: (n_batch, 1, seq_len_query, seq_len_key); mask value 0: no attention
+        # attn_bias: make_attention_bias(mask) precomputed by the caller; if given, it is used instead of mask
+        # Fused softmax(Q x K^T / sqrt(d_k)) x V; the score matrix is not materialized on the flash/efficient backends
+        # Additive -1e9 rather than a bool mask: rows of padded queries are fully masked, and -1e9 keeps them a
+        # uniform average (as before) where a bool mask would turn them into NaN/zeros
+        attn_mask = attn_bias if attn_bias is not None else make_attention_bias(mask, query.dtype)
+        out = F.scaled_dot_product_attention(query, key, value, attn_mask=attn_mask,
+                                             dropout_p=self.dropout.p if self.training else 0.0)
         return out  # (n_batch, h, seq_len_query, d_k)
 
-    def forward(self, *args, query, key, value, mask=None):
+    def forward(self, *args, query, key, value, mask=None, attn_bias=None):
         # query:      (n_batch, seq_len_query, d_embed_query)
         # key, value: (n_batch, seq_len_key,   d_embed_key)
         # mask: (n_batch, seq_len_query, seq_len_key)
+        # attn_bias: optional make_attention_bias(mask), shared across layers; replaces mask if given
         # return value: (n_batch, seq_len_query, d_embed_MHA_out); mostly idempotent: (query)==(return value)
         n_batch = query.size(0)
 
-        def transform(x, x_fc):
-            out = x_fc(x)           # (n_batch, seq_len_x, d_embed_x) -> (n_batch, seq_len_x, d_model)
+        def transform(out):
+            # out: (n_batch, seq_len_x, d_model)
             out = out.view(n_batch, -1, self.h, self.d_model//self.h)  # (n_batch, seq_len_x, h, d_k )
             out = out.transpose(1, 2)
             return out  # (n_batch, h, seq_len_x, d_k)
 
-        query = transform(query, self.q_fc)  # (n_batch, h, seq_len_query, d_k)
-        key = transform(key, self.k_fc)      # (n_batch, h, seq_len_key,   d_k)
-        value = transform(value, self.v_fc)  # (n_batch, h, seq_len_key,   d_k)
+        query = transform(self.q_fc(query))  # (n_batch, h, seq_len_query, d_k)
+        if self.share_kv:  # K == V when key is value; one GEMM either way per distinct input
+            key, value = (self.kv_fc(key),) * 2 if key is value else (self.kv_fc(key), self.kv_fc(value))
+        elif key is value:  # self-attention or a shared encoder output: one GEMM for K and V
+            key, value = self.kv_fc(key).chunk(2, dim=-1)  # (n_batch, seq_len_key, d_model) each
+        else:
+            w_k, w_v = self.kv_fc.weight.chunk(2, dim=0)
+            b_k, b_v = self.kv_fc.bias.chunk(2, dim=0) if self.kv_fc.bias is not None else (None, None)
+            key, value = F.linear(key, w_k, b_k), F.linear(value, w_v, b_v)  # (n_batch, seq_len_key, d_model) each
+        key = transform(key)      # (n_batch, h, seq_len_key,   d_k)
+        value = transform(value)  # (n_batch, h, seq_len_key,   d_k)
 
-        out = self.calculate_attention(query, key, value, mask)  # (n_batch, h,             seq_len_query,  d_k)
+        out = self.calculate_attention(query, key, value, mask, attn_bias)  # (n_batch, h,             seq_len_query,  d_k)
         out = out.transpose(1, 2)                     # (n_batch, seq_len_query, h,              d_k)
-        out = out.contiguous().view(n_batch, -1, self.d_model)   # (n_batch, seq_len_query, d_model)
+        # reshape copies only if needed: SDPA backends that keep the (n_batch, seq_len, h, d_k) memory layout of the
+        # transformed inputs return an output whose transpose is already contiguous
+        out = out.reshape(n_batch, -1, self.d_model)  # (n_batch, seq_len_query, d_model)
         out = self.out_fc(out)
 
         return out  # (n_batch, seq_len_query, d_embed_MHA_out); d_embed_MHA_out == d_embed_query in most cases.
@@ -27,7 +27,9 @@ class RawAttentionScoreGenerator(nn.Module):
         attention_score = torch.matmul(query, key.transpose(-2, -1))  # Calculate the dot product: (Q x K^T)
         attention_score = attention_score / math.sqrt(d_k)  # Scale the attention scores
         if mask is not None:
-            attention_score = attention_score.masked_fill(mask == 0, -1e9)  # Apply the mask to the attention scores
+            # Apply the mask to the attention scores, in place on the fresh score tensor; -1e9 rather than -inf, as the
+            # scores are used as logits downstream (as +/-z pairs, where -inf would turn into inf - inf = NaN)
+            attention_score.masked_fill_(mask == 0, -1e9)
         return attention_score  # (n_batch, seq_len_query, seq_len_key)
 
     def forward(self, input_query, input_key, mask=None):
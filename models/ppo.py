@@ -47,6 +47,8 @@ class LazyControlPPORLlib(TorchModelV2, nn.Module):
             use_residual_in_decoder = cfg["use_residual_in_decoder"] if "use_residual_in_decoder" in cfg else True
             use_FNN_in_decoder = cfg["use_FNN_in_decoder"] if "use_FNN_in_decoder" in cfg else True
             self.scale_factor = cfg["scale_factor"] if "scale_factor" in cfg else 1.0
+            compile_mha = cfg["compile_mha"] if "compile_mha" in cfg else False  # torch.compile the MHA layers
+            share_kv = cfg["share_kv"] if "share_kv" in cfg else False  # W^K == W^V in the MHA layers (less capacity)
 
             if use_residual_in_decoder != use_FNN_in_decoder:
                 warning_text = "Warning: use_residual_in_decoder != use_FNN_in_decoder; may cause unexpected behavior"
@@ -74,6 +76,7 @@ class LazyControlPPORLlib(TorchModelV2, nn.Module):
             kv_fc=nn.Linear(d_embed_input, d_model, is_bias),
             out_fc=nn.Linear(d_model, d_embed_input, is_bias),
             dr_rate=dr_rate,
+            share_kv=share_kv,
         )
         position_ff_encoder = PositionWiseFeedForwardLayer(
             fc1=nn.Linear(d_embed_input, d_ff),
@@ -89,6 +92,7 @@ class LazyControlPPORLlib(TorchModelV2, nn.Module):
             kv_fc=nn.Linear(d_embed_input, d_model_decoder, is_bias),
             out_fc=nn.Linear(d_model_decoder, d_embed_context, is_bias),
             dr_rate=dr_rate,
+            share_kv=share_kv,
         )
         position_ff_decoder = PositionWiseFeedForwardLayer(
             fc1=nn.Linear(d_embed_context, d_ff_decoder),
@@ -163,6 +167,23 @@ class LazyControlPPORLlib(TorchModelV2, nn.Module):
             nn.Linear(in_features=d_embed_context, out_features=1),  # state-value function
         )
 
+        # 4. (Optional) Compile the attention layers with TorchInductor
+        if compile_mha:
+            self.compile_attention_layers()
+
+    def compile_attention_layers(self):
+        """
+        Compiles every MultiHeadAttentionLayer in place (nn.Module.compile, torch>=2.2): the projections, the
+        attention and the head reshapes run as fused kernels. In place, so the state_dict keys do not change
+        (wrapping with torch.compile() would prefix them with _orig_mod). The default mode is used, not
+        reduce-overhead: the batch size varies between the RLlib calls, and CUDA graphs would be re-recorded per shape
+        """
+        if not hasattr(nn.Module, "compile"):
+            raise RuntimeError(f"compile_mha=True requires torch>=2.2 (nn.Module.compile); found torch {torch.__version__}")
+        for module in self.modules():
+            if isinstance(module, MultiHeadAttentionLayer):
+                module.compile()
+
     def forward(
         self,
         input_dict: Dict[str, TensorType],
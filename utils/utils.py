@@ -8,12 +8,31 @@ from ray.rllib.policy.policy import Policy
 from ray.rllib.models import ModelCatalog
 from ray.rllib.policy.sample_batch import SampleBatch
 from typing import Any, Dict, List, Type, Union
+try:
+    from numba import vectorize  # optional; compiles the elementwise wrap helpers into single-pass ufuncs
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+if NUMBA_AVAILABLE:
+    @vectorize(['float32(float32)', 'float64(float64)'], nopython=True, cache=True)
+    def _wrap_to_pi_ufunc(angle):
+        return (angle + np.pi) % (2 * np.pi) - np.pi
+
+    @vectorize(['float32(float32, float32, float32)', 'float64(float64, float64, float64)'], nopython=True, cache=True)
+    def _wrap_to_interval_ufunc(x, center, length):
+        # Same operation order as the numpy fallback in wrap_to_rectangle
+        half = length / 2
+        return ((x - center) + half) % length - half + center
 
 
 def wrap_to_pi(angles):
     """
     Wraps *angles* to **[-pi, pi]**
     """
+    if NUMBA_AVAILABLE:
+        return _wrap_to_pi_ufunc(angles)  # one pass, no intermediate arrays
     return (angles + np.pi) % (2 * np.pi) - np.pi
 
 
@@ -143,13 +162,19 @@ def wrap_to_rectangle(
     :param center: (np.ndarray) The center of the rectangle.
     :return:
     """
-    half_dims = np.array([width / 2, height / 2])
+    if NUMBA_AVAILABLE:
+        # One pass, no intermediate arrays; broadcasts (x, y) against the (cx, cy) and (width, height) pairs
+        return _wrap_to_interval_ufunc(p, np.asarray(center, dtype=p.dtype), np.array([width, height], dtype=p.dtype))
+
+    # Keep the dtype of p (e.g. float32 states stay float32)
+    center = np.asarray(center, dtype=p.dtype)
+    half_dims = np.array([width / 2, height / 2], dtype=p.dtype)
 
     # Translate points to the rectangle centered at the origin
     p_centered = p - center
 
     # Wrap coordinates within the rectangle dimensions
-    p_centered = (p_centered + half_dims) % np.array([width, height]) - half_dims
+    p_centered = (p_centered + half_dims) % np.array([width, height], dtype=p.dtype) - half_dims
 
     # Translate points back to the original center
     p_wrapped = p_centered + center
@@ -202,7 +227,7 @@ def map_periodic_to_continuous_space(coordinates, width, height, center=np.array
     np.ndarray: Transformed positions with shape (num_agents, num_agents, 4) containing [x_cos, x_sin, y_cos, y_sin].
     """
     # Normalize the coordinates to the range [-1, 1]
-    normalized_positions = 2 * (coordinates - center) / np.array([width, height])
+    normalized_positions = 2 * (coordinates - center) / np.array([width, height], dtype=coordinates.dtype)
 
     # Apply cosine and sine transformations
     cos_positions = np.cos(np.pi * normalized_positions)